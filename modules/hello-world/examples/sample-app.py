@@ -5,13 +5,17 @@
 # truncated or shortened for brevity.
 
 import argparse
+import functools
+import itertools
+import json
 import math
 import uuid
 import jwt  # from PyJWT
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from random import random
 from flasgger import Swagger, SwaggerView
-from flask import Flask, jsonify, make_response, request
+from flask import Flask, Response, jsonify, make_response, request, stream_with_context
 from flask.blueprints import Blueprint
 from flask_classy import FlaskView
 from flask_cors import CORS, cross_origin
@@ -20,7 +24,7 @@ from flask_cors import CORS, cross_origin
 import couchbase.search as FT
 import couchbase.subdocument as SD
 from couchbase.cluster import Cluster
-from couchbase.options import ClusterOptions, SearchOptions
+from couchbase.options import ClusterOptions, GetMultiOptions, SearchOptions
 from couchbase.auth import PasswordAuthenticator
 from couchbase.exceptions import *
 
@@ -125,21 +129,30 @@ class AirportView(SwaggerView):
         if sameCase and len(partialAirportName) == 3:
             queryPrep += "faa=$1"
             queryArgs = [partialAirportName.upper()]
+            results = airportsByCode(queryPrep, *queryArgs)
         elif sameCase and len(partialAirportName) == 4:
             queryPrep += "icao=$1"
             queryArgs = [partialAirportName.upper()]
+            results = airportsByCode(queryPrep, *queryArgs)
         else:
             queryPrep += "POSITION(LOWER(airportname), $1) = 0"
             queryArgs = [partialAirportName.lower()]
-
-        results = cluster.query(queryPrep, *queryArgs)
-        airports = [x for x in results]
+            results = cluster.query(queryPrep, *queryArgs)
 
         context = [queryType + queryPrep]
 
-        response = make_response(jsonify({"data": airports, "context": context}))
-        return response
+        return streamJSON(results, context)
 # end::airports-endpoint[]
+# tag::airports-by-code[]
+# No TTL or invalidation, unlike the QueryResultCache of the query how-to:
+# airports are reference data which this app never writes, and which only
+# change when travel-sample is reloaded, which means restarting the app.
+# maxsize bounds the memory, there are fewer airport codes than that.
+@functools.lru_cache(maxsize=4096)
+def airportsByCode(queryPrep, code):
+    """Looks up airports by their FAA or ICAO code, caching the rows"""
+    return tuple(cluster.query(queryPrep, code))
+# end::airports-by-code[]
 # tag::flights-class[]
 class FlightPathsView(SwaggerView):
     """ FlightPath class for computed flights between two airports FAA codes"""
@@ -187,15 +200,11 @@ class FlightPathsView(SwaggerView):
                                      tofaa=queryTo, 
                                      dayofweek=flightDay)
 
-        routesList = []
-        for route in routeResults:
-            route['price'] = math.ceil(random() * 500) + 250
-            routesList.append(route)
+        routes = (dict(route, price=math.ceil(random() * 500) + 250) for route in routeResults)
 
         context.append(queryType + routeQueryPrep)
 
-        response = make_response(jsonify({"data": routesList, "context": context}))
-        return response
+        return streamJSON(routes, context)
 
 # end::flights-second-query[]
 
@@ -309,12 +318,17 @@ class TenantUserView(SwaggerView):
                 bookedFlightKeys = lookupResult.content_as[list](0)
 # end::view-flight-get-keys[]
 # tag::view-flight-get-details[]
-            rows = []
-            for key in bookedFlightKeys:
-                rows.append(flights.get(key).content_as[dict])
+            # Fetch every booking in a single batched call rather than one
+            # round trip per key. Missing bookings are reported per key
+            # instead of failing the whole request.
+            rows, missingKeys = getbookings(flights, bookedFlightKeys)
+
+            queryType = f"KV get_multi - scoped to {scope.name}.users: for {len(bookedFlightKeys)} bookings in document "
+            context = [queryType + userDocumentKey]
+            if missingKeys:
+                context.append(f"{len(missingKeys)} bookings not found: {', '.join(missingKeys)}")
 
-            queryType = f"KV get - scoped to {scope.name}.users: for {len(bookedFlightKeys)} bookings in document "
-            response = make_response(jsonify({"data": rows, "context": [queryType + userDocumentKey]}))
+            response = make_response(jsonify({"data": rows, "missing": missingKeys, "context": context}))
             return response
         
         except DocumentNotFoundException:
@@ -364,6 +378,19 @@ class TenantUserView(SwaggerView):
             return abortmsg(500, "Couldn't update flights")
 # end::update-user[]
 
+# tag::hotel-fetch-modes[]
+# How the hotels endpoint collects the fields for each search hit:
+#   subdoc     - one lookup_in per hit, issued one after another
+#   concurrent - the same lookup_in calls, issued in parallel
+#   fields     - no KV calls; the search service returns the stored fields
+HOTEL_FETCH_MODES = ('subdoc', 'concurrent', 'fields')
+HOTEL_ADDRESS_FIELDS = ['address', 'city', 'state', 'country']
+HOTEL_DATA_FIELDS = ['name', 'description']
+
+hotelLookupPool = ThreadPoolExecutor(max_workers=16)
+# end::hotel-fetch-modes[]
+
+
 class HotelView(SwaggerView):
     """Class for storing Hotel search related information"""
 # tag::search-query[]
@@ -374,6 +401,10 @@ class HotelView(SwaggerView):
         """Find hotels using full text search
         ...
         """
+        fetchMode = request.args.get('fetch', 'subdoc')
+        if fetchMode not in HOTEL_FETCH_MODES:
+            return abortmsg(400, f"Unknown fetch mode: {fetchMode}")
+
         queryPrep = FT.ConjunctionQuery()
         if location != '*' and location != "":
             queryPrep.conjuncts.append(
@@ -399,48 +430,126 @@ class HotelView(SwaggerView):
             response = {'data': [], 'context': [queryType]}
             return jsonify(response)
 
-        searchRows = cluster.search_query('hotels-index', 
-                                          queryPrep, 
-                                          SearchOptions(limit=100))
+        searchOpts = SearchOptions(limit=100)
+        if fetchMode == 'fields':
+            # The fields must be stored in the index for FTS to return them.
+            searchOpts = SearchOptions(limit=100, fields=[*HOTEL_ADDRESS_FIELDS, *HOTEL_DATA_FIELDS])
+
+        searchRows = cluster.search_query('hotels-index', queryPrep, searchOpts)
 # end::search-query[]
 # tag::search-subdoc[]
-        allResults = []
-        addressFields = ['address', 'city', 'state', 'country']
-        dataFields = ['name', 'description']
-
         scope = bucket.scope('inventory')
         hotel_collection = scope.collection('hotel')
 
-        for hotel in searchRows:
-
-            hotelFields = hotel_collection.lookup_in(
-                hotel.id, [SD.get(x) for x in [*addressFields, *dataFields]])
-
-            # Concatenates the first 4 fields to form the address. 
-            hotelAddress = []
-            for x in range(len(addressFields)):
-                try:
-                    hotelAddress.append(hotelFields.content_as[str](x))
-                except DocumentNotFoundException:
-                    pass
-            hotelAddress = ', '.join(hotelAddress)
-
-            hotelData = {}
-            for x, field in enumerate(dataFields):
-                try:    
-                    hotelData[field] = hotelFields.content_as[str](x+len(addressFields))
-                except DocumentNotFoundException:
-                    pass
-                
-            hotelData['address'] = hotelAddress
-            allResults.append(hotelData)
-
-        queryType = f"FTS search - scoped to: {scope.name}.hotel within fields {','.join([*addressFields, *dataFields])}"
+        if fetchMode == 'fields':
+            allResults = [hotelFromFields(hotel.fields or {}) for hotel in searchRows]
+        elif fetchMode == 'concurrent':
+            # Materialise the hits first so every lookup can be in flight at once.
+            hotelIds = [hotel.id for hotel in searchRows]
+            allResults = list(hotelLookupPool.map(
+                lambda hotelId: lookupHotel(hotel_collection, hotelId), hotelIds))
+        else:
+            allResults = [lookupHotel(hotel_collection, hotel.id) for hotel in searchRows]
+
+        queryType = f"FTS search ({fetchMode}) - scoped to: {scope.name}.hotel within fields {','.join([*HOTEL_ADDRESS_FIELDS, *HOTEL_DATA_FIELDS])}"
         response = {'data': allResults, 'context': [queryType]}
         return jsonify(response)
 # end::search-subdoc[]
 
 
+# tag::hotel-helpers[]
+def lookupHotel(hotel_collection, hotelId):
+    """Fetches the address and description fields of one hotel with a
+    single sub-document lookup."""
+    hotelFields = hotel_collection.lookup_in(
+        hotelId, [SD.get(x) for x in [*HOTEL_ADDRESS_FIELDS, *HOTEL_DATA_FIELDS]])
+
+    # Concatenates the first 4 fields to form the address.
+    hotelAddress = []
+    for x in range(len(HOTEL_ADDRESS_FIELDS)):
+        try:
+            hotelAddress.append(hotelFields.content_as[str](x))
+        except (DocumentNotFoundException, PathNotFoundException):
+            pass
+
+    hotelData = {}
+    for x, field in enumerate(HOTEL_DATA_FIELDS):
+        try:
+            hotelData[field] = hotelFields.content_as[str](x+len(HOTEL_ADDRESS_FIELDS))
+        except (DocumentNotFoundException, PathNotFoundException):
+            pass
+
+    hotelData['address'] = ', '.join(hotelAddress)
+    return hotelData
+
+
+def hotelFromFields(fields):
+    """Builds the same hotel shape as lookupHotel from the stored fields
+    returned on a search row."""
+    hotelAddress = [fields[x] for x in HOTEL_ADDRESS_FIELDS if fields.get(x)]
+
+    hotelData = {x: fields[x] for x in HOTEL_DATA_FIELDS if x in fields}
+    hotelData['address'] = ', '.join(hotelAddress)
+    return hotelData
+# end::hotel-helpers[]
+
+
+# tag::get-bookings[]
+def getbookings(collection, keys):
+    """Returns the booking documents for the given keys, in the same order,
+    along with the keys that could not be found.
+    """
+    if not keys:
+        return [], []
+
+    multiResult = collection.get_multi(keys, GetMultiOptions(return_exceptions=True))
+
+    rows = []
+    missingKeys = []
+    for key in keys:
+        if key in multiResult.results:
+            rows.append(multiResult.results[key].content_as[dict])
+        elif isinstance(multiResult.exceptions.get(key), DocumentNotFoundException):
+            missingKeys.append(key)
+        else:
+            raise multiResult.exceptions[key]
+
+    return rows, missingKeys
+# end::get-bookings[]
+
+
+# tag::stream-json[]
+def streamJSON(rows, context, chunkSize=100):
+    """Streams {"data": rows, "context": context} as the rows are read from the query,
+    chunkSize rows at a time, instead of building the whole response in memory"""
+    # read the first row before the response starts, so a failed query
+    # is still reported with a 500 rather than a truncated 200
+    rows = iter(rows)
+    try:
+        head = [next(rows)]
+    except StopIteration:
+        head = []
+    except CouchbaseException as e:
+        return abortmsg(500, "Query failed: " + str(e))
+
+    def generate():
+        yield '{"data": ['
+        chunk = []
+        first = True
+        for row in itertools.chain(head, rows):
+            chunk.append(json.dumps(row))
+            if len(chunk) == chunkSize:
+                yield ('' if first else ',') + ','.join(chunk)
+                chunk = []
+                first = False
+        if chunk:
+            yield ('' if first else ',') + ','.join(chunk)
+        yield '], "context": ' + json.dumps(context) + '}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+# end::stream-json[]
+
+
 def abortmsg(code, message):
     response = jsonify({'message': message})
     response.status_code = code
@@ -0,0 +1,162 @@
+# Latency harness for the access patterns used in 'sample-app.py'.
+#
+# Compares the original one-get-per-booking loop used by the `getflights`
+# endpoint against a single batched `get_multi` call, for users holding
+# 10, 100 and 1000 bookings. Booking documents are seeded into the
+# `tenant_agent_00.bookings` collection of `travel-sample` and removed
+# again once the run completes.
+#
+# It then compares the three ways the `hotels` endpoint can collect the
+# fields for each search hit: serial `lookup_in` calls, concurrent
+# `lookup_in` calls, and stored fields returned by the search service.
+
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import couchbase.search as FT
+import couchbase.subdocument as SD
+from couchbase.auth import PasswordAuthenticator
+from couchbase.cluster import Cluster
+from couchbase.exceptions import DocumentNotFoundException, PathNotFoundException
+from couchbase.options import ClusterOptions, GetMultiOptions, SearchOptions
+
+BOOKING_COUNTS = [10, 100, 1000]
+ITERATIONS = 5
+
+# The sample application uses 'hotels-index'; the test setup creates
+# 'travel-sample-index', which only stores the description field.
+HOTEL_INDEX = "travel-sample-index"
+HOTEL_FIELDS = ['address', 'city', 'state', 'country', 'name', 'description']
+
+cluster = Cluster(
+    "couchbase://your-ip",
+    ClusterOptions(PasswordAuthenticator("Administrator", "password")))
+cluster.wait_until_ready(timedelta(seconds=5))
+
+bookings = cluster.bucket("travel-sample").scope("tenant_agent_00").collection("bookings")
+
+booking = {
+    "destinationairport": "JFK",
+    "equipment": "76W 764",
+    "flight": "AF453",
+    "name": "Air France",
+    "price": 371,
+    "sourceairport": "LHR",
+    "utc": "08:00:00",
+    "date": "05/17/2023"
+}
+
+
+# tag::serial[]
+def get_bookings_serial(collection, keys):
+    rows = []
+    missing_keys = []
+    for key in keys:
+        try:
+            rows.append(collection.get(key).content_as[dict])
+        except DocumentNotFoundException:
+            missing_keys.append(key)
+    return rows, missing_keys
+# end::serial[]
+
+
+# tag::batched[]
+def get_bookings_batched(collection, keys):
+    if not keys:
+        return [], []
+
+    multi_result = collection.get_multi(keys, GetMultiOptions(return_exceptions=True))
+
+    rows = []
+    missing_keys = []
+    for key in keys:
+        if key in multi_result.results:
+            rows.append(multi_result.results[key].content_as[dict])
+        elif isinstance(multi_result.exceptions.get(key), DocumentNotFoundException):
+            missing_keys.append(key)
+        else:
+            raise multi_result.exceptions[key]
+    return rows, missing_keys
+# end::batched[]
+
+
+def time_call(func, *args):
+    timings = []
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+for count in BOOKING_COUNTS:
+    keys = [str(uuid.uuid4()) for _ in range(count)]
+    bookings.upsert_multi({key: booking for key in keys})
+    # one key that was never written, so both paths exercise the miss handling
+    keys.append(str(uuid.uuid4()))
+
+    try:
+        serial_rows, serial_missing = get_bookings_serial(bookings, keys)
+        batched_rows, batched_missing = get_bookings_batched(bookings, keys)
+        assert serial_rows == batched_rows
+        assert serial_missing == batched_missing == keys[-1:]
+
+        serial_ms = time_call(get_bookings_serial, bookings, keys)
+        batched_ms = time_call(get_bookings_batched, bookings, keys)
+        print("{0:>5} bookings: serial {1:9.2f} ms, get_multi {2:9.2f} ms ({3:.1f}x)".format(
+            count, serial_ms, batched_ms, serial_ms / batched_ms))
+    finally:
+        bookings.remove_multi(keys[:-1])
+
+
+# tag::hotel-modes[]
+def hotels_subdoc(collection, hotel_ids):
+    return [lookup_hotel(collection, hotel_id) for hotel_id in hotel_ids]
+
+
+def hotels_concurrent(collection, hotel_ids):
+    return list(lookup_pool.map(lambda hotel_id: lookup_hotel(collection, hotel_id), hotel_ids))
+
+
+def lookup_hotel(collection, hotel_id):
+    result = collection.lookup_in(hotel_id, [SD.get(x) for x in HOTEL_FIELDS])
+    hotel = {}
+    for idx, field in enumerate(HOTEL_FIELDS):
+        try:
+            hotel[field] = result.content_as[str](idx)
+        except PathNotFoundException:
+            pass
+    return hotel
+# end::hotel-modes[]
+
+
+def search_hotels(fields=None):
+    opts = SearchOptions(limit=100)
+    if fields:
+        opts = SearchOptions(limit=100, fields=fields)
+    return list(cluster.search_query(HOTEL_INDEX, FT.QueryStringQuery("description:hotel"), opts))
+
+
+def search_then_lookup(mode):
+    hotel_ids = [row.id for row in search_hotels()]
+    return mode(hotels, hotel_ids)
+
+
+def search_with_fields():
+    return [row.fields or {} for row in search_hotels(HOTEL_FIELDS)]
+
+
+hotels = cluster.bucket("travel-sample").scope("inventory").collection("hotel")
+lookup_pool = ThreadPoolExecutor(max_workers=16)
+
+hit_count = len(search_hotels())
+subdoc_ms = time_call(search_then_lookup, hotels_subdoc)
+concurrent_ms = time_call(search_then_lookup, hotels_concurrent)
+fields_ms = time_call(search_with_fields)
+print("{0:>5} hotel hits: subdoc {1:9.2f} ms, concurrent {2:9.2f} ms, fields {3:9.2f} ms".format(
+    hit_count, subdoc_ms, concurrent_ms, fields_ms))
+
+lookup_pool.shutdown()
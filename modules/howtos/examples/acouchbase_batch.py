@@ -0,0 +1,82 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Sequence, Union
+
+
+# tag::run_bounded[]
+async def run_bounded(items,            # type: Sequence[Any]
+                      operation,        # type: Callable[[Any], Awaitable[Any]]
+                      concurrency=64    # type: int
+                      ) -> List[Union[Any, Exception]]:
+    """Runs `operation` for each item, with at most `concurrency` operations in flight at once.
+
+    Rather than creating a task for every item up front, `concurrency` workers take the items
+    in turn, so the number of tasks, and the memory they need, doesn't grow with the number
+    of items.
+
+    Returns:
+        List: The result, or the exception raised, for each item, in the order of `items`
+    """
+    results = [None] * len(items)
+    next_index = iter(range(len(items)))
+
+    async def worker():
+        # the event loop runs one worker at a time, so taking the next index needs no lock
+        for i in next_index:
+            try:
+                results[i] = await operation(items[i])
+            except Exception as ex:
+                results[i] = ex
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(items)))))
+    return results
+# end::run_bounded[]
+
+
+# tag::kv_many[]
+async def get_many(collection,
+                   keys,            # type: Iterable[str]
+                   *opts,           # type: Any
+                   concurrency=64,  # type: int
+                   **kwargs         # type: Any
+                   ) -> List[Union[Any, Exception]]:
+    """Gets each key with `collection.get()`, with at most `concurrency` gets in flight.
+
+    Returns:
+        List: The `GetResult`, or the exception raised, for each key, in the order of `keys`
+    """
+    return await run_bounded(list(keys),
+                             lambda key: collection.get(key, *opts, **kwargs),
+                             concurrency)
+
+
+async def upsert_many(collection,
+                      docs,             # type: Dict[str, Any]
+                      *opts,            # type: Any
+                      concurrency=64,   # type: int
+                      **kwargs          # type: Any
+                      ) -> List[Union[Any, Exception]]:
+    """Upserts each document with `collection.upsert()`, with at most `concurrency` upserts in flight.
+
+    Returns:
+        List: The `MutationResult`, or the exception raised, for each document, in the order of `docs`
+    """
+    return await run_bounded(list(docs.items()),
+                             lambda item: collection.upsert(item[0], item[1], *opts, **kwargs),
+                             concurrency)
+
+
+async def remove_many(collection,
+                      keys,             # type: Iterable[str]
+                      *opts,            # type: Any
+                      concurrency=64,   # type: int
+                      **kwargs          # type: Any
+                      ) -> List[Union[Any, Exception]]:
+    """Removes each key with `collection.remove()`, with at most `concurrency` removes in flight.
+
+    Returns:
+        List: The `MutationResult`, or the exception raised, for each key, in the order of `keys`
+    """
+    return await run_bounded(list(keys),
+                             lambda key: collection.remove(key, *opts, **kwargs),
+                             concurrency)
+# end::kv_many[]
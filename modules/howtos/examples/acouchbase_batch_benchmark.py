@@ -0,0 +1,155 @@
+'''
+Benchmark for the bounded fan-out helpers in 'acouchbase_batch.py'.
+
+Runs get_many, upsert_many and remove_many with increasing concurrency
+limits against a local stand-in for the data service: a TCP server which
+answers each request after a fixed service time, handling requests
+concurrently, over one multiplexed connection, like the SDK's own. The
+throughput of the serial loop is limited by the round trip; with fan-out it
+scales with the concurrency limit until the client or the server saturates.
+
+No cluster connection is needed.
+
+python acouchbase_batch_benchmark.py
+python acouchbase_batch_benchmark.py --service-time-ms 0.5 --ops 20000
+
+'''
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from couchbase.exceptions import DocumentNotFoundException
+
+from acouchbase_batch import get_many, remove_many, upsert_many
+
+CONCURRENCY_LIMITS = (1, 4, 16, 64, 256)
+
+
+class StandInServer(object):
+    """A key-value server on localhost, answering each request after `service_time` seconds."""
+
+    def __init__(self, service_time):
+        self._service_time = service_time
+        self._docs = {}
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        pending = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            task = asyncio.ensure_future(self._handle(json.loads(line), writer))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+        writer.close()
+
+    async def _handle(self, request, writer):
+        await asyncio.sleep(self._service_time)
+        op, key = request['op'], request['key']
+        response = {'id': request['id']}
+        if op == 'upsert':
+            self._docs[key] = request['doc']
+        elif key not in self._docs:
+            response['error'] = 'not found'
+        elif op == 'get':
+            response['doc'] = self._docs[key]
+        else:
+            del self._docs[key]
+        writer.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class StandInCollection(object):
+    """Just enough of an `acouchbase` collection to run the helpers against `StandInServer`."""
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._ids = itertools.count()
+        self._waiting = {}
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    @classmethod
+    async def connect(cls, port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        return cls(reader, writer)
+
+    async def close(self):
+        self._writer.close()
+        await self._dispatcher
+
+    def get(self, key):
+        return self._request({'op': 'get', 'key': key})
+
+    def upsert(self, key, doc):
+        return self._request({'op': 'upsert', 'key': key, 'doc': doc})
+
+    def remove(self, key):
+        return self._request({'op': 'remove', 'key': key})
+
+    async def _request(self, request):
+        request['id'] = next(self._ids)
+        future = self._waiting[request['id']] = asyncio.get_event_loop().create_future()
+        self._writer.write((json.dumps(request) + '\n').encode('utf-8'))
+        response = await future
+        if 'error' in response:
+            raise DocumentNotFoundException()
+        return response.get('doc')
+
+    async def _dispatch(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                return
+            response = json.loads(line)
+            self._waiting.pop(response['id']).set_result(response)
+
+
+async def run(ops, service_time):
+    server = StandInServer(service_time)
+    port = await server.start()
+    collection = await StandInCollection.connect(port)
+    docs = {'doc::{}'.format(i): {'id': i, 'type': 'airline', 'name': 'Airline {}'.format(i)}
+            for i in range(ops)}
+
+    print('{} operations, {:.1f}ms service time'.format(ops, service_time * 1000))
+    start = time.perf_counter()
+    for key in list(docs)[:ops // 10]:
+        await collection.upsert(key, docs[key])
+    print('{0:>12} upsert {1:>8.0f} ops/s'.format('serial', (ops // 10) / (time.perf_counter() - start)))
+
+    for concurrency in CONCURRENCY_LIMITS:
+        rates = []
+        for operation, arg in ((upsert_many, docs), (get_many, docs.keys()), (remove_many, docs.keys())):
+            start = time.perf_counter()
+            results = await operation(collection, arg, concurrency=concurrency)
+            rates.append(len(results) / (time.perf_counter() - start))
+            assert not any(isinstance(res, Exception) for res in results)
+        print('{0:>12} upsert {1:>8.0f} ops/s, get {2:>8.0f} ops/s, remove {3:>8.0f} ops/s'.format(
+            'limit {}'.format(concurrency), *rates))
+
+    # results come back in input order, exceptions included
+    missing = await get_many(collection, ['doc::0', 'doc::1'])
+    assert all(isinstance(res, DocumentNotFoundException) for res in missing)
+
+    await collection.close()
+    await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ops', type=int, default=5000)
+    parser.add_argument('--service-time-ms', type=float, default=1.0)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args.ops, args.service_time_ms / 1000))
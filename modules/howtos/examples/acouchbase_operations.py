@@ -16,6 +16,9 @@ import couchbase.search as search
 # used for analytics operations
 from couchbase.options import AnalyticsOptions
 
+# used for bounded fan-out key-value operations
+from acouchbase_batch import get_many, remove_many, upsert_many
+
 # tag::create[]
 
 # needed for cluster creation
@@ -111,6 +114,26 @@ async def analytics_query(cluster):
         print(ex)
 # end::analytics[]
 
+
+# tag::kv_many[]
+async def kv_many_operations(collection):
+    docs = {"hotel_batch_{}".format(i): {"type": "hotel", "id": i, "name": "Hotel {}".format(i)}
+            for i in range(100)}
+    # at most 16 upserts in flight at once
+    results = await upsert_many(collection, docs, concurrency=16)
+    print("Upserted {} documents".format(len(results)))
+
+    keys = list(docs) + ["not-a-key"]
+    # a result, or the exception raised, for each key, in the order of the keys
+    for key, res in zip(keys, await get_many(collection, keys, concurrency=16)):
+        if isinstance(res, DocumentNotFoundException):
+            print("Document not found: {}".format(key))
+        elif isinstance(res, CouchbaseException):
+            print("Failed to get {}: {}".format(key, res))
+
+    await remove_many(collection, docs, concurrency=16)
+# end::kv_many[]
+
 loop = get_event_loop()
 cluster, bucket = loop.run_until_complete(get_couchbase())
 # get a reference to the default collection, required for older Couchbase server versions
@@ -123,3 +146,4 @@ loop.run_until_complete(sub_doc_operations(cb_coll))
 loop.run_until_complete(n1ql_query(cluster))
 loop.run_until_complete(search_query(cluster))
 loop.run_until_complete(analytics_query(cluster))
+loop.run_until_complete(kv_many_operations(cb_coll))
@@ -0,0 +1,225 @@
+'''
+Bulk exporter, streaming a collection to compressed JSON Lines.
+
+Pages through the keys of a collection with keyset pagination on META().id,
+fetches each page of documents with concurrent key-value gets, and appends
+them to a gzip or zstd compressed JSON Lines file. Only one page of
+documents is held in memory at a time. After each page, a checkpoint is
+saved, so an interrupted export resumes where it stopped.
+
+python bulk_exporter.py airlines.jsonl.gz --bucket travel-sample --scope inventory \\
+    --collection airline
+python bulk_exporter.py routes.jsonl.zst --bucket travel-sample --scope inventory \\
+    --collection route --page-size 5000
+
+The collection needs a primary index, or another index on META().id. zstd
+compression needs the zstandard package:  python -m pip install zstandard
+
+Every page is compressed as its own gzip member or zstd frame, which
+standard tools read as one stream, e.g.:  zcat airlines.jsonl.gz | head
+
+'''
+import argparse
+import gzip
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from couchbase.auth import PasswordAuthenticator
+from couchbase.cluster import Cluster
+from couchbase.exceptions import DocumentNotFoundException
+from couchbase.options import ClusterOptions, GetMultiOptions, QueryOptions
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# tag::page_keys[]
+def fetch_key_page(cluster,
+                   keyspace,    # type: str
+                   after,       # type: Optional[str]
+                   page_size    # type: int
+                   ) -> List[str]:
+    """Returns the next `page_size` document keys of `keyspace`, in order, after the key `after`.
+
+    Keyset pagination: each page starts from the last key of the one before, so every page is a
+    range scan of the index from that key, however deep into the collection the export is.
+    `OFFSET` would have the query service skip over all the earlier keys for every page.
+    """
+    if after is None:
+        statement = 'SELECT RAW META(d).id FROM {} d ORDER BY META(d).id LIMIT $limit'
+        params = {'limit': page_size}
+    else:
+        statement = 'SELECT RAW META(d).id FROM {} d WHERE META(d).id > $after ORDER BY META(d).id LIMIT $limit'
+        params = {'after': after, 'limit': page_size}
+    result = cluster.query(statement.format(keyspace), QueryOptions(named_parameters=params))
+    return list(result.rows())
+
+
+def fetch_documents(collection,
+                    keys    # type: List[str]
+                    ) -> Dict[str, Dict]:
+    """Fetches the documents of `keys` with concurrent key-value gets, skipping deleted documents."""
+    result = collection.get_multi(keys, GetMultiOptions(return_exceptions=True))
+    for key, ex in result.exceptions.items():
+        # deleted since its key was read, anything else fails the export
+        if not isinstance(ex, DocumentNotFoundException):
+            raise ex
+    docs = {key: res.content_as[dict] for key, res in result.results.items()}
+    # keep the order of the keys, so the file is sorted by key
+    return {key: docs[key] for key in keys if key in docs}
+# end::page_keys[]
+
+
+# tag::export_writer[]
+class ExportWriter(object):
+    """Appends pages of documents to a compressed JSON Lines file, and checkpoints after each one.
+
+    Every page is compressed as its own gzip member or zstd frame, and appended in a single
+    write.  The checkpoint records the size of the file after the last complete page, so on
+    resume, anything written after it, such as half a page from a crash, is truncated away.
+
+    Without a checkpoint, an existing file is only replaced if `overwrite` is set, so a
+    missing or misnamed checkpoint can't wipe out an earlier export.
+
+    Args:
+        path (str): The file to write
+        compression (str): 'gzip' or 'zstd'
+        checkpoint_path (str): The checkpoint file
+        overwrite (bool): Whether to replace an existing file which has no checkpoint
+
+    Raises:
+        FileExistsError: If `path` exists, but there is no checkpoint, and `overwrite` isn't set
+        RuntimeError: If there is a checkpoint, but `path` is missing or shorter than the checkpoint
+    """
+
+    def __init__(self, path, compression, checkpoint_path, overwrite=False):
+        if compression == 'zstd' and zstandard is None:
+            raise RuntimeError('zstd compression needs the zstandard package')
+        self._compress = (zstandard.ZstdCompressor().compress if compression == 'zstd'
+                          else gzip.compress)
+        self._checkpoint_path = checkpoint_path
+        self.checkpoint = self._load_checkpoint()
+        if self.checkpoint is None:
+            if os.path.exists(path) and not overwrite:
+                raise FileExistsError('{} exists, but there is no checkpoint {} to resume from'.format(
+                    path, checkpoint_path))
+            self.checkpoint = {'last_key': None, 'exported': 0, 'offset': 0}
+        elif self.checkpoint['offset'] > (os.path.getsize(path) if os.path.exists(path) else 0):
+            # resuming would leave the earlier pages missing, and a gap of zeros in the file
+            raise RuntimeError('{} is missing or shorter than its checkpoint {}, remove the checkpoint '
+                               'to start the export again'.format(path, checkpoint_path))
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'wb')
+        self._file.truncate(self.checkpoint['offset'])
+        self._file.seek(self.checkpoint['offset'])
+
+    def write_page(self, docs):
+        lines = ''.join(json.dumps({'id': key, 'doc': doc}) + '\n' for key, doc in docs.items())
+        self._file.write(self._compress(lines.encode('utf-8')))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def save_checkpoint(self, last_key, exported):
+        self.checkpoint = {'last_key': last_key, 'exported': exported, 'offset': self._file.tell()}
+        tmp_path = self._checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.checkpoint, f)
+        # replacing the file is atomic, so the checkpoint is never half written
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def close(self):
+        self._file.close()
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._checkpoint_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+# end::export_writer[]
+
+
+# tag::export[]
+def export_collection(cluster,
+                      collection,
+                      keyspace,         # type: str
+                      writer,           # type: ExportWriter
+                      page_size=1000    # type: int
+                      ) -> int:
+    """Exports every document of `keyspace` to `writer`, from its last checkpoint.
+
+    While one page of documents is fetched and written, the keys of the next page are
+    queried, so the key-value gets and the query overlap.
+
+    Returns:
+        int: The number of documents exported, including those of earlier runs
+    """
+    last_key = writer.checkpoint['last_key']
+    exported = writer.checkpoint['exported']
+    start = time.perf_counter()
+    run_exported = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        keys = fetch_key_page(cluster, keyspace, last_key, page_size)
+        while keys:
+            next_keys = executor.submit(fetch_key_page, cluster, keyspace, keys[-1], page_size)
+            docs = fetch_documents(collection, keys)
+            writer.write_page(docs)
+            exported += len(docs)
+            run_exported += len(docs)
+            writer.save_checkpoint(keys[-1], exported)
+            elapsed = time.perf_counter() - start
+            print('Exported {} documents ({:.0f} docs/s)'.format(exported, run_exported / elapsed))
+            keys = next_keys.result()
+    return exported
+# end::export[]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Export a Couchbase collection to compressed JSON Lines.')
+    parser.add_argument('path', help='a .jsonl.gz or .jsonl.zst file')
+    parser.add_argument('--connstr', default='couchbase://your-ip')
+    parser.add_argument('--username', default='Administrator')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--bucket', default='travel-sample')
+    parser.add_argument('--scope', default='_default')
+    parser.add_argument('--collection', default='_default')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'],
+                        help='defaults to zstd for .zst files, gzip otherwise')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--checkpoint', help='defaults to the path with .checkpoint appended')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='replace the file if it exists without a checkpoint')
+    return parser.parse_args(args)
+
+
+def main(opts):
+    compression = opts.compression or ('zstd' if opts.path.endswith('.zst') else 'gzip')
+    checkpoint = opts.checkpoint or opts.path + '.checkpoint'
+    cluster = Cluster(opts.connstr, ClusterOptions(PasswordAuthenticator(opts.username, opts.password)))
+    collection = cluster.bucket(opts.bucket).scope(opts.scope).collection(opts.collection)
+    keyspace = '`{}`.`{}`.`{}`'.format(opts.bucket, opts.scope, opts.collection)
+
+    try:
+        writer = ExportWriter(opts.path, compression, checkpoint, overwrite=opts.overwrite)
+    except FileExistsError as ex:
+        raise SystemExit('{}, use --overwrite to replace it'.format(ex))
+    except RuntimeError as ex:
+        raise SystemExit(str(ex))
+    if writer.checkpoint['last_key'] is not None:
+        print('Resuming after {} documents, from key {}'.format(
+            writer.checkpoint['exported'], writer.checkpoint['last_key']))
+    start = time.perf_counter()
+    try:
+        exported = export_collection(cluster, collection, keyspace, writer, opts.page_size)
+    finally:
+        writer.close()
+    print('Export complete: {} documents in {}, {:.1f}s'.format(
+        exported, opts.path, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,258 @@
+'''
+Bulk loader for JSON Lines and CSV files.
+
+Streams documents from a file, groups them into batches, and upserts the
+batches from a thread pool (with `upsert_multi`) or from asyncio tasks (with
+`acouchbase`), keeping at most `--window` documents in flight. Failed keys
+are collected per batch, and a throughput and latency report is printed at
+the end.
+
+python bulk_loader.py airlines.jsonl --bucket travel-sample --scope inventory \\
+    --collection airline --key "airline_{id}"
+python bulk_loader.py routes.csv --mode async --window 4000 --errors failed.jsonl
+
+Each line of a JSON Lines file is one document. The first line of a CSV file
+names the fields, and values which parse as JSON (numbers, booleans, ...) are
+stored as such. Keys are built from the documents with `--key`, a
+`str.format` template, "{type}_{id}" by default.
+
+'''
+import argparse
+import asyncio
+import csv
+import functools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Tuple
+
+from couchbase.auth import PasswordAuthenticator
+from couchbase.exceptions import CouchbaseException
+from couchbase.options import ClusterOptions, UpsertMultiOptions
+
+from metrics_helpers import nearest_rank
+
+
+# tag::read_documents[]
+def read_documents(path  # type: str
+                   ) -> Iterator[Dict]:
+    """Yields the documents of a JSON Lines or CSV file, one at a time, without reading the whole file."""
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield {field: _parse_value(value) for field, value in row.items()}
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def batch_documents(docs,           # type: Iterable[Dict]
+                    key_template,   # type: str
+                    batch_size      # type: int
+                    ) -> Iterator[Tuple[Dict[str, Dict], Dict[str, str]]]:
+    """Groups documents into batches of `batch_size`, keyed with `key_template`.
+
+    A document whose key was already used earlier in the file is invalid, rather than silently
+    replacing the earlier document.  The line of every key is kept for this, but not the documents.
+
+    Yields:
+        Tuple: The documents of the batch by key, and the documents which couldn't be keyed,
+            by line number, with the reason
+    """
+    batch, invalid, lines = {}, {}, {}
+    for line, doc in enumerate(docs, start=1):
+        try:
+            key = key_template.format(**doc)
+        except (KeyError, IndexError) as ex:
+            invalid['line {}'.format(line)] = 'no field {} to build the key'.format(ex)
+        except TypeError:
+            invalid['line {}'.format(line)] = 'not a JSON object'
+        else:
+            if key in lines:
+                invalid['line {}'.format(line)] = 'duplicate key {}, already used by line {}'.format(
+                    key, lines[key])
+            else:
+                batch[key] = doc
+                lines[key] = line
+        if len(batch) + len(invalid) >= batch_size:
+            yield batch, invalid
+            batch, invalid = {}, {}
+    if batch or invalid:
+        yield batch, invalid
+# end::read_documents[]
+
+
+# tag::load_report[]
+class LoadReport(object):
+    """Thread-safe record of a bulk load: documents loaded, failures by key, and batch latencies."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.loaded = 0
+        self.errors = {}
+        self.batch_latencies = []
+
+    def record_batch(self, loaded, errors, seconds):
+        with self._lock:
+            self.loaded += loaded
+            self.errors.update(errors)
+            self.batch_latencies.append(seconds)
+
+    def record_errors(self, errors):
+        with self._lock:
+            self.errors.update(errors)
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self._start
+        with self._lock:
+            latencies = sorted(self.batch_latencies)
+            loaded, failed = self.loaded, len(self.errors)
+        lines = ['Loaded {} documents, {} failed, in {:.1f}s ({:.0f} docs/s)'.format(
+            loaded, failed, elapsed, loaded / elapsed if elapsed else 0)]
+        if latencies:
+            lines.append('Batch latency over {} batches: p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms'.format(
+                len(latencies), *(nearest_rank(latencies, p) * 1000 for p in (50, 95, 99))))
+        return '\n'.join(lines)
+
+    def write_errors(self, path):
+        with self._lock, open(path, 'w') as f:
+            for key, error in self.errors.items():
+                f.write(json.dumps({'key': key, 'error': error}) + '\n')
+# end::load_report[]
+
+
+# tag::load_threaded[]
+def upsert_batch(collection, batch, invalid, report):
+    start = time.perf_counter()
+    failed = {}
+    if batch:
+        try:
+            result = collection.upsert_multi(batch, UpsertMultiOptions(return_exceptions=True))
+            failed = {key: str(ex) for key, ex in result.exceptions.items()}
+        except CouchbaseException as ex:
+            failed = {key: str(ex) for key in batch}
+    report.record_batch(len(batch) - len(failed), dict(invalid, **failed), time.perf_counter() - start)
+
+
+def load_threaded(collection,
+                  batches,      # type: Iterable[Tuple[Dict[str, Dict], Dict[str, str]]]
+                  workers,      # type: int
+                  window,       # type: int
+                  batch_size,   # type: int
+                  report        # type: LoadReport
+                  ):
+    """Upserts the batches from a pool of `workers` threads, with at most `window` documents in flight.
+
+    The file is only read as fast as batches complete: once the window is full, reading
+    waits for a batch to finish, so memory use stays flat however large the file is.
+    """
+    in_flight = threading.BoundedSemaphore(max(1, window // batch_size))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch, invalid in batches:
+            in_flight.acquire()
+            future = executor.submit(upsert_batch, collection, batch, invalid, report)
+            future.add_done_callback(functools.partial(batch_done, batch, invalid, report, in_flight.release))
+
+
+def batch_done(batch, invalid, report, release, future):
+    """Releases the batch's place in the window, and records the whole batch as failed if
+    uploading it raised, so no error is lost in an unread future."""
+    release()
+    if future.cancelled():
+        return
+    ex = future.exception()
+    if ex is not None:
+        report.record_errors(dict(invalid, **{key: str(ex) for key in batch}))
+# end::load_threaded[]
+
+
+# tag::load_async[]
+async def upsert_batch_async(collection, batch, invalid, report):
+    start = time.perf_counter()
+    keys = list(batch)
+    results = await asyncio.gather(*(collection.upsert(key, batch[key]) for key in keys),
+                                   return_exceptions=True)
+    failed = {key: str(res) for key, res in zip(keys, results) if isinstance(res, Exception)}
+    report.record_batch(len(keys) - len(failed), dict(invalid, **failed), time.perf_counter() - start)
+
+
+async def load_async(collection,
+                     batches,       # type: Iterable[Tuple[Dict[str, Dict], Dict[str, str]]]
+                     window,        # type: int
+                     batch_size,    # type: int
+                     report         # type: LoadReport
+                     ):
+    """Upserts the batches from asyncio tasks on one thread, with at most `window` documents in flight."""
+    in_flight = asyncio.Semaphore(max(1, window // batch_size))
+    tasks = set()
+    for batch, invalid in batches:
+        await in_flight.acquire()
+        task = asyncio.ensure_future(upsert_batch_async(collection, batch, invalid, report))
+        task.add_done_callback(functools.partial(batch_done, batch, invalid, report, in_flight.release))
+        task.add_done_callback(tasks.discard)
+        tasks.add(task)
+    await asyncio.gather(*tasks)
+# end::load_async[]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Bulk load JSON Lines or CSV documents into Couchbase.')
+    parser.add_argument('path', help='a .jsonl or .csv file')
+    parser.add_argument('--connstr', default='couchbase://your-ip')
+    parser.add_argument('--username', default='Administrator')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--bucket', default='travel-sample')
+    parser.add_argument('--scope', default='_default')
+    parser.add_argument('--collection', default='_default')
+    parser.add_argument('--key', default='{type}_{id}', help='template for document keys')
+    parser.add_argument('--mode', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--workers', type=int, default=8, help='threads, in threads mode')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--window', type=int, default=8000, help='the most documents in flight')
+    parser.add_argument('--errors', help='file to write the failed keys to, as JSON Lines')
+    return parser.parse_args(args)
+
+
+def main(opts):
+    authenticator = PasswordAuthenticator(opts.username, opts.password)
+    batches = batch_documents(read_documents(opts.path), opts.key, opts.batch_size)
+    report = LoadReport()
+
+    if opts.mode == 'threads':
+        from couchbase.cluster import Cluster
+        cluster = Cluster(opts.connstr, ClusterOptions(authenticator))
+        collection = cluster.bucket(opts.bucket).scope(opts.scope).collection(opts.collection)
+        load_threaded(collection, batches, opts.workers, opts.window, opts.batch_size, report)
+    else:
+        from acouchbase.cluster import Cluster, get_event_loop
+
+        async def run():
+            cluster = Cluster(opts.connstr, ClusterOptions(authenticator))
+            bucket = cluster.bucket(opts.bucket)
+            await bucket.on_connect()
+            collection = bucket.scope(opts.scope).collection(opts.collection)
+            await load_async(collection, batches, opts.window, opts.batch_size, report)
+
+        get_event_loop().run_until_complete(run())
+
+    print(report.summary())
+    if report.errors:
+        for key, error in list(report.errors.items())[:10]:
+            print('  {}: {}'.format(key, error))
+        if opts.errors:
+            report.write_errors(opts.errors)
+            print('All {} failures written to {}'.format(len(report.errors), opts.errors))
+
+
+if __name__ == '__main__':
+    main(parse_args())
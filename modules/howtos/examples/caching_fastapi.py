@@ -9,9 +9,13 @@ NOTE:  make sure to change into the working
 uvicorn caching_fastapi:app --reload
 
 '''
+import asyncio
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import timedelta
 
 from fastapi import FastAPI, HTTPException, Body
+from fastapi.responses import StreamingResponse
 
 from acouchbase.cluster import Cluster
 from couchbase.cluster import ClusterOptions
@@ -21,71 +25,164 @@ from couchbase.exceptions import (
     DocumentExistsException,
     DocumentNotFoundException)
 from couchbase.collection import InsertOptions, UpsertOptions
+from couchbase.options import QueryOptions
+
+from client_registry import ClientRegistry
+from query_streaming import astream_json
 
 
 class CouchbaseClient(object):
 
     @classmethod
+    @asynccontextmanager
     async def create_client(_, *args, **kwargs):
-        self = CouchbaseClient(*args)
-        client = await self.ping()
-        # need to check for more than just a result
-        # shown as example starting point
-        if not client:
-            await self.connect(**kwargs)
-        return self
-
-    _instance = None
-
-    def __new__(cls, host, bucket, username, pw):
-        if CouchbaseClient._instance is None:
-            CouchbaseClient._instance = object.__new__(cls)
-            CouchbaseClient._instance.host = host
-            CouchbaseClient._instance.bucket_name = bucket
-            CouchbaseClient._instance.username = username
-            CouchbaseClient._instance.password = pw
-        return CouchbaseClient._instance
-
-    async def connect(self, **kwargs):
-        # note: kwargs would be how one could pass in
-        #       more info for client config
+        # checks out the client registered for these connection details
+        # for one request, only connecting the first time they are seen,
+        # or when the last connection failed or was closed
+        with registry.client(*args, **kwargs) as client:
+            await client.wait_until_ready()
+            yield client
+
+    def __init__(self, host, bucket, username, pw):
+        self.host = host
+        self.bucket_name = bucket
+        self.username = username
+        self.password = pw
+
+    @staticmethod
+    def open_cluster(host, username, pw):
         # note:  use couchbases:// if using https
-        conn_str = 'couchbase://{0}'.format(self.host)
+        conn_str = 'couchbase://{0}'.format(host)
 
         try:
             cluster_opts = ClusterOptions(
-                authenticator=PasswordAuthenticator(
-                    self.username, self.password))
-            self._cluster = Cluster(conn_str, options=cluster_opts)
-            self._bucket = self._cluster.bucket(self.bucket_name)
-            await self._bucket.on_connect()
-            self._collection = self._bucket.default_collection()
+                authenticator=PasswordAuthenticator(username, pw))
+            return Cluster(conn_str, options=cluster_opts)
         except CouchbaseException as error:
             print('Could not connect to cluster. Error: {}'.format(error))
             raise
 
-    async def ping(self):
+    def connect(self, cluster=None, **kwargs):
+        # note: kwargs would be how one could pass in
+        #       more info for client config
+        if cluster is None:
+            cluster = CouchbaseClient.open_cluster(
+                self.host, self.username, self.password)
+
+        self._cluster = cluster
+        self._bucket = self._cluster.bucket(self.bucket_name)
+        # started by the first request, every request waits on the same one
+        self._connected = None
+        # concurrent gets for the same key share one request to the cluster
+        self.single_flight = kwargs.get('single_flight', True)
+        # how long to remember that a key does not exist, None to disable
+        self._not_found_ttl = kwargs.get('not_found_ttl', None)
+        self._in_flight = {}
+        self._not_found = {}
+        self._fetching = {}
+        self.backend_gets = 0
+
+    async def wait_until_ready(self):
+        if self._connected is None:
+            self._connected = asyncio.ensure_future(self._bucket.on_connect())
         try:
-            return not self._bucket.closed
-        except AttributeError:
-            # if the _bucket attr doesn't exist, neither does the client
+            await asyncio.shield(self._connected)
+        except CouchbaseException as error:
+            print('Could not connect to cluster. Error: {}'.format(error))
+            raise
+        self._collection = self._bucket.default_collection()
+
+    def is_healthy(self):
+        # still connecting counts as healthy, a failed connection doesn't
+        connected = self._connected
+        if connected is None or not connected.done():
+            return True
+        if connected.cancelled() or connected.exception() is not None:
             return False
+        return not self._bucket.closed
+
+    def close(self):
+        # nothing runs in the background, the registry closes the cluster
+        pass
+
+    async def ping(self):
+        return self.is_healthy()
+
+    def query(self, statement, *args, **kwargs):
+        return self._cluster.query(statement, *args, **kwargs)
 
+    # tag::single_flight[]
     async def get(self, key, **kwargs):
         # note: kwargs would be how one could pass in
         #       more info for GetOptions
-        return await self._collection.get(key)
+        expires_at = self._not_found.get(key)
+        if expires_at is not None:
+            if expires_at > time.monotonic():
+                # a new exception each time, re-raising the cached one
+                # would keep adding to its traceback
+                raise DocumentNotFoundException()
+            del self._not_found[key]
+
+        if not self.single_flight:
+            return await self._fetch(key)
+
+        fut = self._in_flight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._fetch(key))
+            self._in_flight[key] = fut
+            fut.add_done_callback(lambda f: self._request_done(key, f))
+        # shield the shared request, so one caller being cancelled
+        # does not cancel it for every other caller waiting on it
+        return await asyncio.shield(fut)
+
+    async def _fetch(self, key):
+        self.backend_gets += 1
+        # [writes to the key, fetches of it in flight], kept while any are
+        fetching = self._fetching.setdefault(key, [0, 0])
+        writes = fetching[0]
+        fetching[1] += 1
+        try:
+            return await self._collection.get(key)
+        except DocumentNotFoundException:
+            # a write during the get may have created the document since
+            if self._not_found_ttl is not None and fetching[0] == writes:
+                expires_at = time.monotonic() + self._not_found_ttl.total_seconds()
+                self._not_found[key] = expires_at
+            raise
+        finally:
+            fetching[1] -= 1
+            if fetching[1] == 0:
+                del self._fetching[key]
+
+    def _request_done(self, key, fut):
+        # a write may already have replaced this request with a newer one
+        if self._in_flight.get(key) is fut:
+            del self._in_flight[key]
+
+    def _invalidate(self, key):
+        # later gets must not join a request started before this write
+        self._in_flight.pop(key, None)
+        self._not_found.pop(key, None)
+        if key in self._fetching:
+            self._fetching[key][0] += 1
+    # end::single_flight[]
 
     async def insert(self, key, doc, **kwargs):
         opts = InsertOptions(expiry=kwargs.get('expiry', None))
-        return await self._collection.insert(key, doc, opts)
+        result = await self._collection.insert(key, doc, opts)
+        self._invalidate(key)
+        return result
 
     async def upsert(self, key, doc, **kwargs):
         opts = UpsertOptions(expiry=kwargs.get('expiry', None))
-        return await self._collection.upsert(key, doc, opts)
+        result = await self._collection.upsert(key, doc, opts)
+        self._invalidate(key)
+        return result
 
     async def remove(self, key, **kwargs):
-        return await self._collection.remove(key)
+        result = await self._collection.remove(key)
+        self._invalidate(key)
+        return result
 
 
 # done for example purposes only, some
@@ -98,6 +195,18 @@ db_info = {
 }
 
 
+registry = ClientRegistry(
+    CouchbaseClient,
+    # acouchbase closes the cluster asynchronously
+    close_cluster=lambda cluster: asyncio.ensure_future(cluster.close()),
+    max_clusters=4)
+
+# note: these are only applied when the client first connects
+client_opts = {
+    'single_flight': True,
+    'not_found_ttl': timedelta(seconds=5)
+}
+
 EXPIRY = timedelta(minutes=1)
 app = FastAPI()
 
@@ -107,10 +216,10 @@ app = FastAPI()
 @app.get('/')
 async def ping():
     try:
-        cb = await CouchbaseClient.create_client(*db_info.values())
-        if await cb.ping():
-            return 'Cluster is ready!'
-        return 'Cluster not ready.'
+        async with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+            if await cb.ping():
+                return 'Cluster is ready!'
+            return 'Cluster not ready.'
     except CouchbaseException as e:
         return HTTPException(status_code=500,
                              detail='Unexpected error: {}'.format(e))
@@ -119,9 +228,9 @@ async def ping():
 @app.get('/{key}')
 async def get(key: str):
     try:
-        cb = await CouchbaseClient.create_client(*db_info.values())
-        res = await cb.get(key)
-        return res.content_as[dict]
+        async with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+            res = await cb.get(key)
+            return res.content_as[dict]
     except DocumentNotFoundException:
         return HTTPException(status_code=404,
                              detail='Key not found')
@@ -133,9 +242,9 @@ async def get(key: str):
 @app.post('/{key}')
 async def post(key: str, request: dict = Body(...)):
     try:
-        cb = await CouchbaseClient.create_client(*db_info.values())
-        await cb.insert(key, request, expiry=EXPIRY)
-        return 'OK'
+        async with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+            await cb.insert(key, request, expiry=EXPIRY)
+            return 'OK'
     except DocumentExistsException:
         return HTTPException(status_code=409,
                              detail='Key already exists')
@@ -147,9 +256,9 @@ async def post(key: str, request: dict = Body(...)):
 @app.put('/{key}')
 async def put(key: str, request: dict = Body(...)):
     try:
-        cb = await CouchbaseClient.create_client(*db_info.values())
-        await cb.upsert(key, request, expiry=EXPIRY)
-        return 'OK'
+        async with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+            await cb.upsert(key, request, expiry=EXPIRY)
+            return 'OK'
     except CouchbaseException as e:
         return HTTPException(status_code=500,
                              detail='Unexpected error: {}'.format(e))
@@ -158,12 +267,42 @@ async def put(key: str, request: dict = Body(...)):
 @app.delete('/{key}')
 async def delete(key):
     try:
-        cb = await CouchbaseClient.create_client(*db_info.values())
-        await cb.remove(key)
-        return 'OK'
+        async with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+            await cb.remove(key)
+            return 'OK'
     except DocumentNotFoundException:
         return HTTPException(status_code=404,
                              detail='Key not found')
     except CouchbaseException as e:
         return HTTPException(status_code=500,
                              detail='Unexpected error: {}'.format(e))
+
+
+# tag::stream_query[]
+@app.get('/query/docs')
+async def query_docs(limit: int = 1000):
+    statement = 'SELECT META(d).id, d AS doc FROM `{}` d LIMIT $limit'.format(
+        db_info['bucket'])
+    try:
+        async with AsyncExitStack() as checkout:
+            cb = await checkout.enter_async_context(
+                CouchbaseClient.create_client(*db_info.values(), **client_opts))
+            result = cb.query(statement, QueryOptions(named_parameters={'limit': limit}))
+            pieces = astream_json(result, extra={'context': [statement]})
+            # runs the query, and raises any error, before the response starts
+            head = await pieces.__anext__()
+            # the client stays checked out until the last row is sent
+            release = checkout.pop_all()
+    except CouchbaseException as e:
+        return HTTPException(status_code=500,
+                             detail='Unexpected error: {}'.format(e))
+
+    async def body():
+        async with release:
+            yield head
+            async for piece in pieces:
+                yield piece
+
+    # each chunk of rows is sent as it is read, the result is never held in memory
+    return StreamingResponse(body(), media_type='application/json')
+# end::stream_query[]
@@ -0,0 +1,70 @@
+'''
+Load test for the single-flight get in 'caching_fastapi.py'.
+
+Many concurrent workers read keys drawn from a zipfian distribution, so a
+handful of hot keys receive most of the traffic. The run is repeated with
+single-flight disabled and enabled, and reports how many requests reached
+the cluster for the same client-side load.
+
+python caching_fastapi_load_test.py
+
+'''
+import asyncio
+import random
+import time
+
+from acouchbase.cluster import get_event_loop
+from couchbase.exceptions import DocumentNotFoundException
+
+from caching_fastapi import CouchbaseClient, client_opts, db_info
+
+KEY_COUNT = 1000
+# keys at the tail of the distribution are never written, to exercise
+# the negative cache as well
+MISSING_KEYS = 100
+ZIPF_EXPONENT = 1.1
+WORKERS = 200
+REQUESTS = 20000
+
+keys = ['zipf::{}'.format(i) for i in range(KEY_COUNT)]
+weights = [1 / (rank + 1) ** ZIPF_EXPONENT for rank in range(KEY_COUNT)]
+
+
+async def worker(cb, requests):
+    for key in random.choices(keys, weights=weights, k=requests):
+        try:
+            await cb.get(key)
+        except DocumentNotFoundException:
+            pass
+
+
+async def run(cb, single_flight):
+    cb.single_flight = single_flight
+    cb.backend_gets = 0
+    # start each run without the previous run's negative cache entries
+    cb._not_found.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(cb, REQUESTS // WORKERS) for _ in range(WORKERS)])
+    elapsed = time.perf_counter() - start
+
+    print('single_flight={0}: {1} requests in {2:.2f}s ({3:.0f}/s), '
+          '{4} backend gets ({5:.0f}/s, {6:.1%} of requests)'.format(
+              single_flight, REQUESTS, elapsed, REQUESTS / elapsed,
+              cb.backend_gets, cb.backend_gets / elapsed, cb.backend_gets / REQUESTS))
+
+
+async def main():
+    async with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+        for key in keys[:-MISSING_KEYS]:
+            await cb.upsert(key, {'key': key})
+
+        await run(cb, single_flight=False)
+        await run(cb, single_flight=True)
+
+        for key in keys[:-MISSING_KEYS]:
+            await cb.remove(key)
+
+
+if __name__ == '__main__':
+    loop = get_event_loop()
+    loop.run_until_complete(main())
@@ -11,9 +11,13 @@ NOTE:  make sure to change into the working
 flask run
 
 '''
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
 from datetime import timedelta
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 
 from couchbase.cluster import Cluster
 from couchbase.options import ClusterOptions
@@ -24,45 +28,135 @@ from couchbase.exceptions import (
     DocumentNotFoundException)
 from couchbase.collection import InsertOptions, UpsertOptions
 from couchbase.diagnostics import PingState
+from couchbase.options import GetOptions, QueryOptions
+
+from client_registry import ClientRegistry
+from query_streaming import stream_json
+
+
+# tag::local_cache[]
+class LocalCache(object):
+    """Bounded, in-process LRU cache of `GetResult` objects with a TTL.
+
+    Writes leave a tombstone holding the CAS of the mutation, so a read that
+    raced with the write can't put an older version of the document back
+    into the cache. A result read with `GetOptions(with_expiry=True)` is
+    cached no longer than the document lives in Couchbase.
+    """
+
+    def __init__(self, max_size=1000, ttl=timedelta(minutes=1)):
+        self._max_size = max_size
+        self._ttl = ttl.total_seconds()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['result'] is None:
+                self.misses += 1
+                return None
+            if entry['expires_at'] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry['result']
+
+    def fill(self, key, result):
+        with self._lock:
+            now = time.monotonic()
+            expires_at = now + self._ttl
+            expiry_time = result.expiry_time
+            if expiry_time is not None and expiry_time.timestamp() > 0:
+                # the document expires in Couchbase before the ttl is up
+                expires_at = min(expires_at, now + expiry_time.timestamp() - time.time())
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] > now:
+                # never replace a newer version of the document
+                if entry['cas'] > result.cas:
+                    return
+                expires_at = min(expires_at, entry['expires_at'])
+            self._set(key, result, result.cas, expires_at)
+
+    def invalidate(self, key, cas, expiry=None):
+        with self._lock:
+            ttl = self._ttl if expiry is None else expiry.total_seconds()
+            self._set(key, None, cas, time.monotonic() + ttl)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+    def _set(self, key, result, cas, expires_at):
+        self._entries[key] = {'result': result, 'cas': cas, 'expires_at': expires_at}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+# end::local_cache[]
 
 
 class CouchbaseClient(object):
 
+    # tag::create_client[]
     @classmethod
     def create_client(_, *args, **kwargs):
-        self = CouchbaseClient(*args)
-        connected = self.ping()
-        if not connected:
-            self.connect(**kwargs)
-        return self
-
-    _instance = None
-
-    def __new__(cls, host, bucket, username, pw):
-        if CouchbaseClient._instance is None:
-            CouchbaseClient._instance = object.__new__(cls)
-            CouchbaseClient._instance.host = host
-            CouchbaseClient._instance.bucket_name = bucket
-            CouchbaseClient._instance.username = username
-            CouchbaseClient._instance.password = pw
-        return CouchbaseClient._instance
-
-    def connect(self, **kwargs):
-        # note: kwargs would be how one could pass in
-        #       more info for client config
-        conn_str = 'couchbase://{0}'.format(self.host)
+        # checks out the client registered for these connection details
+        # for one request, only connecting the first time they are seen,
+        # or when the health check found the last connection unhealthy
+        return registry.client(*args, **kwargs)
+    # end::create_client[]
+
+    def __init__(self, host, bucket, username, pw):
+        self.host = host
+        self.bucket_name = bucket
+        self.username = username
+        self.password = pw
+
+    @staticmethod
+    def open_cluster(host, username, pw):
+        # note:  use couchbases:// if using https
+        conn_str = 'couchbase://{0}'.format(host)
 
         try:
             cluster_opts = ClusterOptions(
-                authenticator=PasswordAuthenticator(
-                    self.username, self.password))
-            self._cluster = Cluster(conn_str, options=cluster_opts)
-            self._bucket = self._cluster.bucket(self.bucket_name)
-            self._collection = self._bucket.default_collection()
+                authenticator=PasswordAuthenticator(username, pw))
+            return Cluster(conn_str, options=cluster_opts)
         except CouchbaseException as error:
             print('Could not connect to cluster. Error: {}'.format(error))
             raise
 
+    def connect(self, cluster=None, **kwargs):
+        # note: kwargs would be how one could pass in
+        #       more info for client config
+        if cluster is None:
+            cluster = CouchbaseClient.open_cluster(
+                self.host, self.username, self.password)
+
+        self._cluster = cluster
+        self._bucket = self._cluster.bucket(self.bucket_name)
+        self._collection = self._bucket.default_collection()
+        self._cache = LocalCache(max_size=kwargs.get('cache_size', 1000),
+                                 ttl=kwargs.get('cache_ttl', timedelta(minutes=1)))
+        # the connection bootstrapped, so treat it as healthy
+        # until the health check thread reports otherwise
+        self._healthy = True
+        self.start_health_check(
+            kwargs.get('health_check_interval', timedelta(seconds=10)))
+
     def ping(self):
         try:
             # if couchbase version >= 3.0.10:
@@ -77,19 +171,69 @@ class CouchbaseClient(object):
             # if the _cluster attr doesn't exist, neither does the client
             return False
 
+    def query(self, statement, *args, **kwargs):
+        return self._cluster.query(statement, *args, **kwargs)
+
+    # tag::health_check[]
+    def is_healthy(self):
+        return getattr(self, '_healthy', False)
+
+    def start_health_check(self, interval):
+        # one thread per client, it always pings the current connection
+        if getattr(self, '_health_thread', None) is not None:
+            return
+        self._health_stop = threading.Event()
+        self._health_thread = threading.Thread(target=self._health_check,
+                                               args=(interval.total_seconds(),),
+                                               name='couchbase-health-check',
+                                               daemon=True)
+        self._health_thread.start()
+
+    def close(self):
+        # called by the registry once the client is dropped; the thread
+        # exits when it next wakes, a request may still be using the client
+        if getattr(self, '_health_thread', None) is not None:
+            self._health_stop.set()
+
+    def _health_check(self, interval):
+        while True:
+            try:
+                self._healthy = self.ping()
+            except CouchbaseException:
+                self._healthy = False
+            if self._health_stop.wait(interval):
+                return
+    # end::health_check[]
+
+    # tag::cached_ops[]
     def get(self, key, **kwargs):
-        return self._collection.get(key)
+        result = self._cache.get(key)
+        if result is None:
+            # the expiry caps how long the document is cached
+            result = self._collection.get(key, GetOptions(with_expiry=True))
+            self._cache.fill(key, result)
+        return result
 
     def insert(self, key, doc, **kwargs):
         opts = InsertOptions(expiry=kwargs.get('expiry', None))
-        return self._collection.insert(key, doc, opts)
+        result = self._collection.insert(key, doc, opts)
+        self._cache.invalidate(key, result.cas, kwargs.get('expiry', None))
+        return result
 
     def upsert(self, key, doc, **kwargs):
         opts = UpsertOptions(expiry=kwargs.get('expiry', None))
-        return self._collection.upsert(key, doc, opts)
+        result = self._collection.upsert(key, doc, opts)
+        self._cache.invalidate(key, result.cas, kwargs.get('expiry', None))
+        return result
 
     def remove(self, key, **kwargs):
-        return self._collection.remove(key)
+        result = self._collection.remove(key)
+        self._cache.invalidate(key, result.cas)
+        return result
+
+    def cache_stats(self):
+        return self._cache.stats()
+    # end::cached_ops[]
 
 
 app = Flask(__name__)
@@ -98,18 +242,28 @@ app = Flask(__name__)
 @app.route('/')
 def ping():
     try:
-        if cb.ping():
-            return 'Cluster is ready!'
-        return 'Cluster not ready.'
+        with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+            if cb.is_healthy():
+                return 'Cluster is ready!'
+            return 'Cluster not ready.'
     except CouchbaseException as e:
         return 'Unexpected error: {}'.format(e), 500
 
+# tag::cache_stats[]
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+        return jsonify(cb.cache_stats())
+# end::cache_stats[]
+
+
 # tag::get[]
 @app.route('/<key>', methods=['GET'])
 def get(key):
     try:
-        res = cb.get(key)
-        return jsonify(res.content_as[dict])
+        with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+            res = cb.get(key)
+            return jsonify(res.content_as[dict])
     except DocumentNotFoundException:
         return 'Key not found', 404
     except CouchbaseException as e:
@@ -120,8 +274,9 @@ def get(key):
 @app.route('/<key>', methods=['POST'])
 def post(key):
     try:
-        cb.insert(key, request.json, expiry=EXPIRY)
-        return 'OK'
+        with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+            cb.insert(key, request.json, expiry=EXPIRY)
+            return 'OK'
     except DocumentExistsException:
         return 'Key already exists', 409
     except CouchbaseException as e:
@@ -133,8 +288,9 @@ def post(key):
 @app.route('/<key>', methods=['PUT'])
 def put(key):
     try:
-        cb.upsert(key, request.json, expiry=EXPIRY)
-        return 'OK'
+        with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+            cb.upsert(key, request.json, expiry=EXPIRY)
+            return 'OK'
     except CouchbaseException as e:
         return 'Unexpected error: {}'.format(e), 500
 # end::put[]
@@ -144,14 +300,45 @@ def put(key):
 @app.route('/<key>', methods=['DELETE'])
 def delete(key):
     try:
-        cb.remove(key)
-        return 'OK'
+        with CouchbaseClient.create_client(*db_info.values(), **client_opts) as cb:
+            cb.remove(key)
+            return 'OK'
     except DocumentNotFoundException:
         # Document already deleted / never existed
         return 'Key does not exist', 404
 # end::delete[]
 
 
+# tag::stream_query[]
+@app.route('/query/docs', methods=['GET'])
+def query_docs():
+    statement = 'SELECT META(d).id, d AS doc FROM `{}` d LIMIT $limit'.format(
+        db_info['bucket'])
+    try:
+        with ExitStack() as checkout:
+            cb = checkout.enter_context(
+                CouchbaseClient.create_client(*db_info.values(), **client_opts))
+            result = cb.query(statement, QueryOptions(
+                named_parameters={'limit': int(request.args.get('limit', 1000))}))
+            pieces = stream_json(result, extra={'context': [statement]})
+            # runs the query, and raises any error, before the response starts
+            head = next(pieces)
+            # the client stays checked out until the last row is sent
+            release = checkout.pop_all().close
+    except CouchbaseException as e:
+        return 'Unexpected error: {}'.format(e), 500
+
+    def body():
+        yield head
+        yield from pieces
+
+    # each chunk of rows is sent as it is read, the result is never held in memory
+    response = Response(stream_with_context(body()), mimetype='application/json')
+    response.call_on_close(release)
+    return response
+# end::stream_query[]
+
+
 # done for example purposes only, some
 # sort of configuration should be used
 db_info = {
@@ -161,8 +348,17 @@ db_info = {
     'password': 'password'
 }
 
+registry = ClientRegistry(CouchbaseClient, max_clusters=4)
+
 EXPIRY = timedelta(minutes=1)
-cb = CouchbaseClient.create_client(*db_info.values())
+# note: these are only applied when the client first connects
+client_opts = {
+    'cache_size': 1000,
+    # the expiry of documents written here; a document read with a shorter
+    # remaining expiry is only cached until it expires in Couchbase
+    'cache_ttl': EXPIRY,
+    'health_check_interval': timedelta(seconds=10)
+}
 
 if __name__ == '__main__':
     app.run()
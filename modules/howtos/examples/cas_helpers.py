@@ -0,0 +1,173 @@
+import copy
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from typing import Callable, Dict, Optional
+
+import couchbase.subdocument as SD
+from couchbase.exceptions import CASMismatchException
+from couchbase.options import MutateInOptions, ReplaceOptions
+from couchbase.result import MutationResult
+
+from retry_policy import Jitter, RetryPolicy
+
+
+# tag::cas_metrics[]
+class CasMetrics(object):
+    """Thread-safe counters describing how contended optimistic (CAS) updates are.
+
+    Records how many attempts each update took, how many attempts lost a CAS race,
+    which keys lose the most races, and whether updates were written as
+    sub-document mutations or full document replacements.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.operations = 0
+        self.attempts = 0
+        self.conflicts = 0
+        self.attempt_histogram = Counter()
+        self.key_conflicts = Counter()
+        self.subdoc_mutations = 0
+        self.full_replacements = 0
+
+    def record(self, key, attempts, conflicts, subdoc):
+        with self._lock:
+            self.operations += 1
+            self.attempts += attempts
+            self.conflicts += conflicts
+            self.attempt_histogram[attempts] += 1
+            if conflicts:
+                self.key_conflicts[key] += conflicts
+            if subdoc is True:
+                self.subdoc_mutations += 1
+            elif subdoc is False:
+                self.full_replacements += 1
+
+    def conflict_rate(self) -> float:
+        with self._lock:
+            return self.conflicts / self.attempts if self.attempts else 0.0
+
+    def hot_keys(self, n=10):
+        with self._lock:
+            return self.key_conflicts.most_common(n)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                'operations': self.operations,
+                'attempts': self.attempts,
+                'conflicts': self.conflicts,
+                'conflict_rate': self.conflicts / self.attempts if self.attempts else 0.0,
+                'attempt_histogram': dict(sorted(self.attempt_histogram.items())),
+                'hot_keys': self.key_conflicts.most_common(10),
+                'subdoc_mutations': self.subdoc_mutations,
+                'full_replacements': self.full_replacements
+            }
+# end::cas_metrics[]
+
+
+# tag::mutate_with_cas[]
+DEFAULT_CAS_POLICY = RetryPolicy(retry_limit=10,
+                                 base_delay=timedelta(milliseconds=10),
+                                 max_delay=timedelta(milliseconds=500),
+                                 jitter=Jitter.DECORRELATED,
+                                 allowed_exceptions=(CASMismatchException,))
+
+_REMOVED = object()
+
+
+def mutate_with_cas(collection,
+                    key,                    # type: str
+                    fn,                     # type: Callable[[Dict], Optional[Dict]]
+                    policy=None,            # type: Optional[RetryPolicy]
+                    metrics=None,           # type: Optional[CasMetrics]
+                    max_subdoc_paths=4      # type: int
+                    ) -> Optional[MutationResult]:
+    """Reads a document, applies `fn` to its content, and writes it back, retrying if the document was changed
+    by someone else in the meantime.
+
+    When `fn` changes no more than `max_subdoc_paths` paths of the document, only those paths are written,
+    with a sub-document `mutate_in`, rather than replacing the whole document.  Either way, the write only
+    succeeds if the document hasn't changed since it was read.
+
+    Args:
+        collection (`couchbase.collection.Collection`): The collection the document is in
+        key (str): The document key
+        fn (Callable): Takes the document content, and either changes it in place or returns the new content
+        policy (`RetryPolicy`, optional): How to retry after a CAS mismatch
+        metrics (`CasMetrics`, optional): Where to record attempts and conflicts
+        max_subdoc_paths (int): The most changed paths to write with `mutate_in`, at most 16
+
+    Returns:
+        `couchbase.result.MutationResult`: The result of the write, or None if `fn` didn't change the document
+    """
+    policy = policy or DEFAULT_CAS_POLICY
+    # a mutate_in takes at most 16 specs, more changes than that replace the document
+    max_subdoc_paths = min(max_subdoc_paths, 16)
+    deadline = policy.deadline({})
+    delay = policy.base_delay
+    attempt = 1
+    conflicts = 0
+    while True:
+        try:
+            result, subdoc = _mutate_once(collection, key, fn, max_subdoc_paths)
+            if metrics is not None:
+                metrics.record(key, attempt, conflicts, subdoc)
+            return result
+        except Exception as ex:
+            if isinstance(ex, CASMismatchException):
+                conflicts += 1
+            delay = policy.next_delay(attempt, delay)
+            if not policy.should_retry(attempt, ex, delay, deadline):
+                if metrics is not None:
+                    metrics.record(key, attempt, conflicts, None)
+                raise
+        time.sleep(delay)
+        attempt += 1
+
+
+def _mutate_once(collection, key, fn, max_subdoc_paths):
+    result = collection.get(key)
+    content = result.content_as[dict]
+    original = copy.deepcopy(content)
+    updated = fn(content)
+    if updated is None:
+        updated = content
+
+    changes = _changed_paths(original, updated) if isinstance(updated, dict) else None
+    if changes is not None and len(changes) == 0:
+        return None, None
+
+    if changes is not None and len(changes) <= max_subdoc_paths:
+        specs = [SD.remove(path) if value is _REMOVED else SD.upsert(path, value)
+                 for path, value in changes]
+        return collection.mutate_in(key, specs, MutateInOptions(cas=result.cas)), True
+
+    return collection.replace(key, updated, ReplaceOptions(cas=result.cas)), False
+
+
+def _changed_paths(old, new, prefix=''):
+    changes = []
+    for k in old:
+        path = _subdoc_path(prefix, k)
+        if k not in new:
+            changes.append((path, _REMOVED))
+        elif old[k] != new[k]:
+            if isinstance(old[k], dict) and isinstance(new[k], dict):
+                changes.extend(_changed_paths(old[k], new[k], path))
+            else:
+                changes.append((path, new[k]))
+    for k in new:
+        if k not in old:
+            changes.append((_subdoc_path(prefix, k), new[k]))
+    return changes
+
+
+def _subdoc_path(prefix, name):
+    # field names containing path syntax must be escaped with backticks
+    if any(c in name for c in '.[]`'):
+        name = '`{}`'.format(name.replace('`', '``'))
+    return '{}.{}'.format(prefix, name) if prefix else name
+# end::mutate_with_cas[]
@@ -0,0 +1,159 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# tag::client_registry[]
+class ClientRegistry(object):
+    """Thread-safe registry of clients, one per (host, bucket, credentials).
+
+    `Cluster` handles are opened lazily and shared by every bucket on the
+    same host with the same credentials. The registry only keeps the books:
+    `client_class` opens the clusters and connects the clients, and
+    `close_cluster` closes a cluster.
+
+    Clients are checked out with `client()` for the length of a request.
+    A client that isn't healthy is dropped at checkout, along with its
+    cluster and the other clients of that cluster, and a new connection is
+    opened in its place. At most `max_clusters` handles are kept; the least
+    recently used one is dropped when another is needed. A dropped cluster
+    is only closed once none of its clients are checked out.
+
+    Args:
+        client_class (type): Takes `(host, bucket, username, pw)`, and has an
+            `open_cluster(host, username, pw)` static method, and `connect(cluster, **kwargs)`,
+            `is_healthy()` and `close()` methods. `close()` only stops the client's
+            background work, a request may still be finishing with it
+        close_cluster (Callable): Closes a cluster handle
+        max_clusters (int): The most cluster handles to keep open
+    """
+
+    def __init__(self, client_class, close_cluster=None, max_clusters=4):
+        self._client_class = client_class
+        self._close_cluster = close_cluster or (lambda cluster: cluster.close())
+        self._max_clusters = max_clusters
+        # least recently used first
+        self._clusters = OrderedDict()
+        self._clients = {}
+        # one per cluster, so connecting never blocks checkouts of other clusters
+        self._connect_locks = {}
+        # dropped while the lock was held, closed once it is released
+        self._closing_clients = []
+        self._closing_clusters = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def client(self, host, bucket, username, pw, **kwargs):
+        """Checks out the client for these connection details, connecting only the first
+        time they are seen, or when the last connection became unhealthy."""
+        client, cluster = self._checkout(host, bucket, username, pw, **kwargs)
+        try:
+            yield client
+        finally:
+            self._release(cluster)
+
+    def close(self):
+        with self._lock:
+            for cluster in list(self._clusters.values()):
+                self._drop(cluster)
+        self._close_dropped()
+
+    def _checkout(self, host, bucket, username, pw, **kwargs):
+        key = (host, bucket, username, pw)
+        cluster_key = (host, username, pw)
+        with self._lock:
+            found = self._lease(key)
+            connect_lock = self._connect_locks.setdefault(cluster_key, threading.Lock())
+        self._close_dropped()
+        if found is not None:
+            return found
+
+        with connect_lock:
+            with self._lock:
+                # another thread may have connected while this one waited
+                found = self._lease(key)
+                cluster = self._clusters.get(cluster_key)
+                if found is None and cluster is not None:
+                    # leased now, so it can't be closed while the client connects
+                    cluster.leases += 1
+            if found is not None:
+                return found
+
+            if cluster is None:
+                cluster = _RegisteredCluster(
+                    cluster_key, self._client_class.open_cluster(host, username, pw))
+                with self._lock:
+                    cluster.leases += 1
+                    self._clusters[cluster_key] = cluster
+                    while len(self._clusters) > self._max_clusters:
+                        self._drop(next(iter(self._clusters.values())))
+            try:
+                client = self._client_class(host, bucket, username, pw)
+                client.connect(cluster=cluster.cluster, **kwargs)
+            except Exception:
+                self._release(cluster)
+                raise
+            with self._lock:
+                if not cluster.dropped:
+                    self._clients[key] = (client, cluster)
+                    cluster.clients.add(key)
+                else:
+                    # dropped while connecting, so it only serves this request
+                    self._closing_clients.append(client)
+        self._close_dropped()
+        return client, cluster
+
+    def _lease(self, key):
+        # holds self._lock
+        found = self._clients.get(key)
+        if found is None:
+            return None
+        client, cluster = found
+        if not client.is_healthy():
+            # reconnect: the cluster is dropped with every client of it
+            self._drop(cluster)
+            return None
+        cluster.leases += 1
+        self._clusters.move_to_end(cluster.key)
+        return found
+
+    def _drop(self, cluster):
+        # holds self._lock
+        if self._clusters.get(cluster.key) is cluster:
+            del self._clusters[cluster.key]
+        for key in cluster.clients:
+            self._closing_clients.append(self._clients.pop(key)[0])
+        cluster.clients.clear()
+        cluster.dropped = True
+        if cluster.leases == 0:
+            self._closing_clusters.append(cluster.cluster)
+
+    def _release(self, cluster):
+        with self._lock:
+            cluster.leases -= 1
+            if cluster.dropped and cluster.leases == 0:
+                self._closing_clusters.append(cluster.cluster)
+        self._close_dropped()
+
+    def _close_dropped(self):
+        # closing can block, so it's never done while holding the lock
+        with self._lock:
+            clients, self._closing_clients = self._closing_clients, []
+            clusters, self._closing_clusters = self._closing_clusters, []
+        for client in clients:
+            # a request may still be finishing with it, only its background work stops
+            client.close()
+        for cluster in clusters:
+            self._close_cluster(cluster)
+
+
+class _RegisteredCluster(object):
+
+    def __init__(self, key, cluster):
+        self.key = key
+        self.cluster = cluster
+        self.clients = set()
+        # requests using a client of this cluster
+        self.leases = 0
+        self.dropped = False
+# end::client_registry[]
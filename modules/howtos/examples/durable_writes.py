@@ -0,0 +1,189 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, Optional, Union
+
+from couchbase.durability import Durability, ServerDurability
+from couchbase.exceptions import (AmbiguousTimeoutException,
+                                  CouchbaseException,
+                                  DocumentExistsException,
+                                  DurabilitySyncWriteAmbiguousException)
+from couchbase.options import InsertOptions, UpsertOptions
+
+from metrics_helpers import nearest_rank
+from retry_policy import Jitter, RetryPolicy
+
+
+# tag::durability_latencies[]
+class DurabilityLatencies(object):
+    """Thread-safe store of durable write latencies, by durability level.
+
+    Keeps the most recent `max_samples` latencies for each level, so the latency
+    of `MAJORITY` and `PERSIST_TO_MAJORITY` writes can be compared on real traffic.
+    """
+
+    def __init__(self, max_samples=10000):
+        self._max_samples = max_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, level, seconds):
+        with self._lock:
+            samples = self._samples.get(level)
+            if samples is None:
+                samples = self._samples[level] = deque(maxlen=self._max_samples)
+            samples.append(seconds)
+
+    def percentiles(self, level, percentiles=(50, 95, 99)) -> Dict[int, timedelta]:
+        with self._lock:
+            samples = sorted(self._samples.get(level, ()))
+        if not samples:
+            return {}
+        return {p: timedelta(seconds=nearest_rank(samples, p)) for p in percentiles}
+
+    def snapshot(self) -> Dict[str, Dict[int, timedelta]]:
+        with self._lock:
+            levels = list(self._samples)
+        return {level.name: self.percentiles(level) for level in levels}
+# end::durability_latencies[]
+
+
+# tag::durable_write[]
+class DurableWriteResult(object):
+    """The outcome of `durable_write`.
+
+    Attributes:
+        cas (int): The CAS of the document after the write
+        mutation_token (`couchbase.mutation_state.MutationToken`): The mutation token of the write, or None
+            if an ambiguous write was confirmed by reading the document back
+        attempts (int): The number of times the write was sent
+        ambiguous (bool): True if any attempt ended with an ambiguous outcome
+    """
+
+    def __init__(self, cas, mutation_token, attempts, ambiguous):
+        self.cas = cas
+        self.mutation_token = mutation_token
+        self.attempts = attempts
+        self.ambiguous = ambiguous
+
+    def __repr__(self):
+        return 'DurableWriteResult(cas={}, attempts={}, ambiguous={})'.format(
+            self.cas, self.attempts, self.ambiguous)
+
+
+AMBIGUOUS_EXCEPTIONS = (DurabilitySyncWriteAmbiguousException, AmbiguousTimeoutException)
+
+DEFAULT_DURABLE_POLICY = RetryPolicy(retry_limit=5,
+                                     base_delay=timedelta(milliseconds=50),
+                                     max_delay=timedelta(seconds=1),
+                                     jitter=Jitter.FULL,
+                                     allowed_exceptions=AMBIGUOUS_EXCEPTIONS)
+
+
+def durable_write(collection,
+                  key,                          # type: str
+                  doc,                          # type: Dict
+                  insert=True,                  # type: bool
+                  level=Durability.MAJORITY,    # type: Durability
+                  policy=None,                  # type: Optional[RetryPolicy]
+                  latencies=None                # type: Optional[DurabilityLatencies]
+                  ) -> DurableWriteResult:
+    """Inserts (or upserts) a document with the given durability level, resolving ambiguous outcomes.
+
+    After a `DurabilitySyncWriteAmbiguousException` or `AmbiguousTimeoutException` an insert reads the
+    document back.  A durable write is not visible to reads until it has been committed, and the insert
+    would have failed if the document already existed, so if the document holds the content that was
+    written, the earlier attempt succeeded and the write is not repeated.  Otherwise it is retried with a
+    bounded, jittered backoff.
+
+    An upsert is always retried: the document may have held the same content before the upsert, so
+    reading it back can't tell whether the upsert was applied.  Upserting the same content again is safe.
+
+    Args:
+        collection (`couchbase.collection.Collection`): The collection to write to
+        key (str): The document key
+        doc (Dict): The document content
+        insert (bool): Insert the document, if False the document is upserted
+        level (`couchbase.durability.Durability`): The durability level
+        policy (`RetryPolicy`, optional): How to retry after an ambiguous outcome
+        latencies (`DurabilityLatencies`, optional): Where to record the latency of the write
+
+    Returns:
+        `DurableWriteResult`: The outcome of the write
+    """
+    policy = policy or DEFAULT_DURABLE_POLICY
+    durability = ServerDurability(level=level)
+    opts = InsertOptions(durability=durability) if insert else UpsertOptions(durability=durability)
+    write = collection.insert if insert else collection.upsert
+
+    start = time.monotonic()
+    deadline = policy.deadline({})
+    delay = policy.base_delay
+    attempt = 1
+    ambiguous = False
+    while True:
+        try:
+            result = write(key, doc, opts)
+            outcome = DurableWriteResult(result.cas, result.mutation_token(), attempt, ambiguous)
+            break
+        except DocumentExistsException:
+            # an earlier, ambiguous, attempt may be the one that created the document
+            outcome = _read_back(collection, key, doc, attempt) if ambiguous else None
+            if outcome is None:
+                raise
+            break
+        except AMBIGUOUS_EXCEPTIONS as ex:
+            ambiguous = True
+            # only an insert can be confirmed by its content, see above
+            outcome = _read_back(collection, key, doc, attempt) if insert else None
+            if outcome is not None:
+                break
+            delay = policy.next_delay(attempt, delay)
+            if not policy.should_retry(attempt, ex, delay, deadline):
+                raise
+        time.sleep(delay)
+        attempt += 1
+
+    if latencies is not None:
+        latencies.record(level, time.monotonic() - start)
+    return outcome
+
+
+def durable_write_many(collection,
+                       docs,                        # type: Dict[str, Dict]
+                       insert=True,                 # type: bool
+                       level=Durability.MAJORITY,   # type: Durability
+                       policy=None,                 # type: Optional[RetryPolicy]
+                       latencies=None,              # type: Optional[DurabilityLatencies]
+                       max_workers=16               # type: int
+                       ) -> Dict[str, Union[DurableWriteResult, CouchbaseException]]:
+    """Runs `durable_write` for many documents concurrently.
+
+    Waiting for durability is mostly waiting on the network, so the writes are issued from a thread pool,
+    with at most `max_workers` in flight at once.
+
+    Returns:
+        Dict: The `DurableWriteResult`, or the exception raised, for each key
+    """
+    def write_one(key):
+        try:
+            return durable_write(collection, key, docs[key], insert, level, policy, latencies)
+        except CouchbaseException as ex:
+            return ex
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(docs, executor.map(write_one, docs)))
+
+
+def _read_back(collection, key, doc, attempts):
+    try:
+        result = collection.get(key)
+    except CouchbaseException:
+        # still can't tell whether the write happened
+        return None
+    if result.content_as[dict] != doc:
+        return None
+    return DurableWriteResult(result.cas, None, attempts, True)
+# end::durable_write[]
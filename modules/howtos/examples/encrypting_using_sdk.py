@@ -1,8 +1,5 @@
-import json
 import traceback
-from typing import List, Dict
 
-from couchbase.encryption import CryptoManager
 from couchbase.cluster import Cluster, ClusterOptions
 from couchbase.auth import PasswordAuthenticator
 from couchbase.exceptions import (
@@ -13,75 +10,8 @@ from couchbase.exceptions import (
 from cbencryption import DefaultCryptoManager, AeadAes256CbcHmacSha512Provider
 from cbencryption.insecure_keyring import InsecureKeyring
 
-# tag::helper_methods[]
-# Create a helper method to encrypt document fields
-def encrypt_doc(
-    crypto_mgr,  # type: "CryptoManager"
-    doc,  # type: Dict
-    field_specs,  # type: List[dict]
-) -> dict:
-    """Helper method that takes the provided field specs and encrypts the matching fields of the provided document.
-
-    Args:
-        crypto_mgr (`couchbase.encryption.CryptoManager`): The crypto manager that contains registries to application's encrypters and decrypters
-        doc (Dict): The document that should have fields encrypted
-        field_specs (List[dict]): List of field specs, a field spec should be a dict containing at least a 'name' field.  Can optionally
-            include 'encrypter_alias' and 'associated_data' fields
-
-    Returns:
-        Dict: The provided document with encrypted fields
-    """
-    encrypted_doc = {}
-    for k, v in doc.items():
-        field_spec = next((fs for fs in field_specs if fs.get("name", None) == k), None)
-        if field_spec:
-            encrypted_val = crypto_mgr.encrypt(
-                json.dumps(v),
-                encrypter_alias=field_spec.get("encrypter_alias", None),
-                associated_data=field_spec.get("associated_data", None),
-            )
-            encrypted_val["ciphertext"] = encrypted_val["ciphertext"].decode("utf-8")
-            encrypted_doc[crypto_mgr.mangle(k)] = encrypted_val
-        else:
-            encrypted_doc[k] = v
-    return encrypted_doc
-
-
-# Create a helper method to decrypt document fields
-def decrypt_doc(
-    crypto_mgr,  # type: "CryptoManager"
-    doc,  # type: Dict
-    field_specs,  # type: List[dict]
-) -> dict:
-    """Helper method that takes the provided field specs and decrypts the matching fields of the provided document.
-
-    Args:
-        crypto_mgr (`couchbase.encryption.CryptoManager`): The crypto manager that contains registries to application's encrypters and decrypters
-        doc (Dict): The document that should have fields encrypted
-        field_specs (List[dict]): List of field specs, a field spec should be a dict containing at least a 'name' field.  Can optionally
-            include 'encrypter_alias' and 'associated_data' fields
-
-    Returns:
-        Dict: The provided document with previously encrypted fields decrypted.
-    """
-    decrypted_doc = {}
-    for k, v in doc.items():
-        if not crypto_mgr.is_mangled(k):
-            decrypted_doc[k] = v
-        else:
-            demangled_key = crypto_mgr.demangle(k)
-            field_spec = next(
-                (fs for fs in field_specs if fs.get("name", None) == demangled_key),
-                None,
-            )
-            if field_spec:
-                decrypted_val = crypto_mgr.decrypt(
-                    v,
-                    associated_data=field_spec.get("associated_data", None),
-                )
-                decrypted_doc[demangled_key] = json.loads(decrypted_val)
-    return decrypted_doc
-# end::helper_methods[]
+from encryption_helpers import FieldSpecs, encrypt_doc, decrypt_doc
+
 
 # Create a keyring and add keys
 # NOTE:  Use a secure keyring for applications, this is shown for example purposes
@@ -116,13 +46,12 @@ crypto_mgr = DefaultCryptoManager()
 # The id of the Key object returned from the store at encryption time is written into the data for the field to be encrypted.
 # The key id that was written is then used on the decrypt side to find the corresponding key from the store.
 encrypter1 = aes256_provider.encrypter_for_key(secret_key_id)
+encrypter2 = aes256_provider.encrypter_for_key(secret_key1_id)
 
 # The alias used here is the value which corresponds to the "encrypted" field annotation.
 try:
     crypto_mgr.register_encrypter("one", encrypter1)
-    crypto_mgr.register_encrypter(
-        "two", aes256_provider.encrypter_for_key(secret_key1_id)
-    )
+    crypto_mgr.register_encrypter("two", encrypter2)
 
     # We don't need to add a default encryptor but if we do then any fields with an
     # empty encrypted tag will use this encryptor.
@@ -133,8 +62,9 @@ except EncrypterAlreadyExistsException as ex:
 # Only set one decrypter per algorithm.
 # The crypto manager will work out which decrypter to use based on the alg field embedded in the field data.
 # The decrypter will use the key embedded in the field data to determine which key to fetch from the key store for decryption.
+decrypter = aes256_provider.decrypter()
 try:
-    crypto_mgr.register_decrypter(aes256_provider.decrypter())
+    crypto_mgr.register_decrypter(decrypter)
 except DecrypterAlreadyExistsException as ex:
     traceback.print_exc()
 # end::provider[]
@@ -182,6 +112,15 @@ field_specs = [
     {"name": "phone"},
 ]
 
+# compile the field specs once, and reuse them for every document,
+# along with the encrypters and decrypters each field should use
+field_specs = FieldSpecs(
+    crypto_mgr,
+    field_specs,
+    encrypters={"one": encrypter1, "two": encrypter2, None: encrypter1},
+    decrypters=[decrypter],
+)
+
 encrypted_user = encrypt_doc(crypto_mgr, user, field_specs)
 
 collection.upsert("user::1", encrypted_user)
@@ -0,0 +1,134 @@
+'''
+Benchmark for the field encryption helpers in 'encryption_helpers.py'.
+
+Encrypts and decrypts 10,000 documents with the original helpers, which
+searched the list of field specs for every key of every document, and with
+compiled `FieldSpecs`, both with and without cached encrypters and
+decrypters, reporting encrypted fields per second. Then runs the same documents through the bulk
+helpers with a thread pool and a process pool. No cluster connection is
+needed.
+
+python encryption_benchmark.py
+
+'''
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cbencryption import DefaultCryptoManager, AeadAes256CbcHmacSha512Provider
+from cbencryption.insecure_keyring import InsecureKeyring
+
+from encryption_helpers import (FieldSpecs, crypto_process_pool, decrypt_doc,
+                                decrypt_docs, encrypt_doc, encrypt_docs)
+
+DOCUMENT_COUNT = 10000
+FIELD_COUNT = 50
+
+
+def create_crypto_manager(crypters=None):
+    keyring = InsecureKeyring()
+    keyring.set_key(
+        "secret_key",
+        bytes.fromhex(
+            "000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f202122232425262728292a2b2c2d2e2f303132333435363738393a3b3c3d3e3f"
+        ),
+    )
+    aes256_provider = AeadAes256CbcHmacSha512Provider(keyring)
+    encrypter = aes256_provider.encrypter_for_key("secret_key")
+    decrypter = aes256_provider.decrypter()
+    crypto_mgr = DefaultCryptoManager()
+    crypto_mgr.register_encrypter("one", encrypter)
+    crypto_mgr.register_decrypter(decrypter)
+    if crypters is not None:
+        crypters.update(encrypters={"one": encrypter}, decrypters=[decrypter])
+    return crypto_mgr
+
+
+crypters = {}
+crypto_mgr = create_crypto_manager(crypters)
+
+# 50 plain fields per document, 5 of which are encrypted
+field_specs = [{"name": "field_{}".format(i), "encrypter_alias": "one"}
+               for i in range(0, FIELD_COUNT, FIELD_COUNT // 5)]
+documents = [{"field_{}".format(i): "value {} of {}".format(i, n) for i in range(FIELD_COUNT)}
+             for n in range(DOCUMENT_COUNT)]
+encrypted_field_count = DOCUMENT_COUNT * len(field_specs)
+
+
+# The helpers as they were before field specs were compiled.
+def encrypt_doc_scan(crypto_mgr, doc, field_specs):
+    encrypted_doc = {}
+    for k, v in doc.items():
+        field_spec = next((fs for fs in field_specs if fs.get("name", None) == k), None)
+        if field_spec:
+            encrypted_val = crypto_mgr.encrypt(
+                json.dumps(v),
+                encrypter_alias=field_spec.get("encrypter_alias", None),
+                associated_data=field_spec.get("associated_data", None),
+            )
+            encrypted_val["ciphertext"] = encrypted_val["ciphertext"].decode("utf-8")
+            encrypted_doc[crypto_mgr.mangle(k)] = encrypted_val
+        else:
+            encrypted_doc[k] = v
+    return encrypted_doc
+
+
+def decrypt_doc_scan(crypto_mgr, doc, field_specs):
+    decrypted_doc = {}
+    for k, v in doc.items():
+        if not crypto_mgr.is_mangled(k):
+            decrypted_doc[k] = v
+        else:
+            demangled_key = crypto_mgr.demangle(k)
+            field_spec = next(
+                (fs for fs in field_specs if fs.get("name", None) == demangled_key),
+                None,
+            )
+            if field_spec:
+                decrypted_val = crypto_mgr.decrypt(
+                    v,
+                    associated_data=field_spec.get("associated_data", None),
+                )
+                decrypted_doc[demangled_key] = json.loads(decrypted_val)
+    return decrypted_doc
+
+
+def run(name, encrypt, decrypt, specs):
+    start = time.perf_counter()
+    encrypted = [encrypt(crypto_mgr, doc, specs) for doc in documents]
+    encrypt_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decrypted = [decrypt(crypto_mgr, doc, specs) for doc in encrypted]
+    decrypt_secs = time.perf_counter() - start
+
+    assert decrypted == documents
+    print("{0:<10} encrypt {1:6.2f}s ({2:8.0f} fields/s), decrypt {3:6.2f}s ({4:8.0f} fields/s)".format(
+        name, encrypt_secs, encrypted_field_count / encrypt_secs,
+        decrypt_secs, encrypted_field_count / decrypt_secs))
+
+
+def run_bulk(name, executor, crypto_mgr, workers=None):
+    start = time.perf_counter()
+    encrypted = encrypt_docs(crypto_mgr, documents, field_specs, executor=executor, workers=workers)
+    # decrypt as documents are encrypted, nothing is held in between
+    decrypted = decrypt_docs(crypto_mgr, encrypted, field_specs, executor=executor, workers=workers)
+    for doc, expected in zip(decrypted, documents):
+        assert doc == expected
+    secs = time.perf_counter() - start
+    print("{0:<10} encrypt+decrypt {1:6.2f}s ({2:8.0f} docs/s)".format(
+        name, secs, DOCUMENT_COUNT / secs))
+
+
+if __name__ == "__main__":
+    run("scan", encrypt_doc_scan, decrypt_doc_scan, field_specs)
+    run("compiled", encrypt_doc, decrypt_doc, FieldSpecs(crypto_mgr, field_specs))
+    run("cached", encrypt_doc, decrypt_doc, FieldSpecs(crypto_mgr, field_specs, **crypters))
+
+    run_bulk("serial", None, crypto_mgr)
+    workers = os.cpu_count()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        run_bulk("threads", executor, crypto_mgr, workers)
+    with crypto_process_pool(create_crypto_manager, max_workers=workers) as executor:
+        run_bulk("processes", executor, None, workers)
@@ -0,0 +1,280 @@
+import os
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+import orjson
+
+from couchbase.encryption import CryptoManager, Decrypter, EncryptionResult, Encrypter
+
+
+# tag::helper_methods[]
+class FieldSpecs(object):
+    """Field specs compiled for repeated use with `encrypt_doc` and `decrypt_doc`.
+
+    Field specs are indexed by name, and the mangled name of every encrypted field
+    is computed once, up front, rather than for every document.
+
+    If the encrypters and decrypters registered with the crypto manager are also
+    provided, they are resolved once per field, and used directly, instead of being
+    looked up by the crypto manager for every field of every document.
+
+    Args:
+        crypto_mgr (`couchbase.encryption.CryptoManager`): The crypto manager used to mangle the field names
+        field_specs (List[dict]): List of field specs, a field spec should be a dict containing at least a 'name' field.
+            The name can be a dotted path (e.g. 'address.street') to encrypt a field of a nested object.  Can optionally
+            include 'encrypter_alias' and 'associated_data' fields
+        encrypters (Dict[str, `couchbase.encryption.Encrypter`], optional): The encrypters registered with the crypto
+            manager, by alias.  Use None as the alias of the default encrypter.
+        decrypters (List[`couchbase.encryption.Decrypter`], optional): The decrypters registered with the crypto manager
+    """
+
+    def __init__(
+        self,
+        crypto_mgr,  # type: "CryptoManager"
+        field_specs,  # type: List[dict]
+        encrypters=None,  # type: Optional[Dict[Optional[str], "Encrypter"]]
+        decrypters=None,  # type: Optional[List["Decrypter"]]
+    ):
+        # the fields encrypted at this level, by name and by mangled name
+        self.fields = {}
+        self.mangled = {}
+        # the field specs for nested objects, by the name of the parent field
+        self.children = {}
+        # encrypters by field name, and decrypters by algorithm
+        self.encrypters = {}
+        self.decrypters = {d.algorithm(): d for d in decrypters or []}
+
+        nested = {}
+        for fs in field_specs:
+            name, _, rest = fs["name"].partition(".")
+            if rest:
+                nested.setdefault(name, []).append(dict(fs, name=rest))
+            else:
+                mangled_name = crypto_mgr.mangle(name)
+                self.fields[name] = (mangled_name, fs)
+                self.mangled[mangled_name] = (name, fs)
+                if encrypters is not None and fs.get("encrypter_alias", None) in encrypters:
+                    self.encrypters[name] = encrypters[fs.get("encrypter_alias", None)]
+
+        for name, specs in nested.items():
+            # the whole object is encrypted, so its nested specs don't apply
+            if name not in self.fields:
+                self.children[name] = FieldSpecs(crypto_mgr, specs, encrypters, decrypters)
+
+
+# Create a helper method to encrypt document fields
+def encrypt_doc(
+    crypto_mgr,  # type: "CryptoManager"
+    doc,  # type: Dict
+    field_specs,  # type: Union[FieldSpecs, List[dict]]
+) -> dict:
+    """Helper method that takes the provided field specs and encrypts the matching fields of the provided document.
+
+    Args:
+        crypto_mgr (`couchbase.encryption.CryptoManager`): The crypto manager that contains registries to application's encrypters and decrypters
+        doc (Dict): The document that should have fields encrypted
+        field_specs (Union[FieldSpecs, List[dict]]): Compiled field specs, or a list of field specs (see `FieldSpecs`).
+            Compile the field specs once when encrypting many documents.
+
+    Returns:
+        Dict: The provided document with encrypted fields
+    """
+    if not isinstance(field_specs, FieldSpecs):
+        field_specs = FieldSpecs(crypto_mgr, field_specs)
+
+    encrypted_doc = {}
+    for k, v in doc.items():
+        field = field_specs.fields.get(k, None)
+        if field:
+            mangled_key, field_spec = field
+            # orjson serializes straight to bytes, which is what gets encrypted
+            encrypter = field_specs.encrypters.get(k, None)
+            if encrypter:
+                encrypted_val = encrypter.encrypt(
+                    orjson.dumps(v),
+                    associated_data=field_spec.get("associated_data", None),
+                ).asdict()
+            else:
+                encrypted_val = crypto_mgr.encrypt(
+                    orjson.dumps(v),
+                    encrypter_alias=field_spec.get("encrypter_alias", None),
+                    associated_data=field_spec.get("associated_data", None),
+                )
+            if isinstance(encrypted_val["ciphertext"], bytes):
+                encrypted_val["ciphertext"] = encrypted_val["ciphertext"].decode("utf-8")
+            encrypted_doc[mangled_key] = encrypted_val
+        elif k in field_specs.children and isinstance(v, dict):
+            encrypted_doc[k] = encrypt_doc(crypto_mgr, v, field_specs.children[k])
+        else:
+            encrypted_doc[k] = v
+    return encrypted_doc
+
+
+# Create a helper method to decrypt document fields
+def decrypt_doc(
+    crypto_mgr,  # type: "CryptoManager"
+    doc,  # type: Dict
+    field_specs,  # type: Union[FieldSpecs, List[dict]]
+) -> dict:
+    """Helper method that takes the provided field specs and decrypts the matching fields of the provided document.
+
+    Args:
+        crypto_mgr (`couchbase.encryption.CryptoManager`): The crypto manager that contains registries to application's encrypters and decrypters
+        doc (Dict): The document that should have fields encrypted
+        field_specs (Union[FieldSpecs, List[dict]]): Compiled field specs, or a list of field specs (see `FieldSpecs`).
+            Compile the field specs once when decrypting many documents.
+
+    Returns:
+        Dict: The provided document with previously encrypted fields decrypted.
+    """
+    if not isinstance(field_specs, FieldSpecs):
+        field_specs = FieldSpecs(crypto_mgr, field_specs)
+
+    decrypted_doc = {}
+    for k, v in doc.items():
+        field = field_specs.mangled.get(k, None)
+        if field:
+            demangled_key, field_spec = field
+            decrypter = field_specs.decrypters.get(v.get("alg", None), None)
+            if decrypter:
+                decrypted_val = decrypter.decrypt(
+                    EncryptionResult.new_encryption_result_from_dict(v),
+                    associated_data=field_spec.get("associated_data", None),
+                )
+            else:
+                decrypted_val = crypto_mgr.decrypt(
+                    v,
+                    associated_data=field_spec.get("associated_data", None),
+                )
+            # orjson parses the decrypted bytes without decoding them to a str first
+            decrypted_doc[demangled_key] = orjson.loads(decrypted_val)
+        elif k in field_specs.children and isinstance(v, dict):
+            decrypted_doc[k] = decrypt_doc(crypto_mgr, v, field_specs.children[k])
+        elif not crypto_mgr.is_mangled(k):
+            decrypted_doc[k] = v
+    return decrypted_doc
+# end::helper_methods[]
+
+
+# tag::bulk_methods[]
+def encrypt_docs(
+    crypto_mgr,  # type: Optional["CryptoManager"]
+    docs,  # type: Iterable[Dict]
+    field_specs,  # type: Union[FieldSpecs, List[dict]]
+    executor=None,  # type: Optional[Executor]
+    chunk_size=100,  # type: int
+    window=None,  # type: Optional[int]
+    workers=None,  # type: Optional[int]
+) -> Iterator[dict]:
+    """Encrypts the matching fields of every document in `docs`, yielding the encrypted documents in input order.
+
+    Documents are read from `docs` lazily and handed to the executor in chunks, with at most `window` chunks
+    in flight at once, so memory stays bounded however many documents there are.
+
+    Args:
+        crypto_mgr (`couchbase.encryption.CryptoManager`): The crypto manager used to encrypt the documents.  Use None
+            with an executor created by `crypto_process_pool`, so each worker process uses its own crypto manager.
+        docs (Iterable[Dict]): The documents that should have fields encrypted
+        field_specs (Union[FieldSpecs, List[dict]]): Compiled field specs, or a list of field specs (see `FieldSpecs`).
+            Pass a list of field specs when using a process pool.
+        executor (`concurrent.futures.Executor`, optional): The executor to encrypt chunks of documents in.  If not
+            provided, documents are encrypted one at a time in the calling thread.
+        chunk_size (int): The number of documents in each task submitted to the executor
+        window (int, optional): The maximum number of chunks in flight.  Defaults to twice `workers`.
+        workers (int, optional): The number of workers in the executor, used for the default `window`.  Defaults to
+            the number of CPUs, as for a `ProcessPoolExecutor` created without `max_workers`.
+
+    Returns:
+        Iterator[Dict]: The provided documents with encrypted fields
+    """
+    return _crypt_docs(encrypt_doc, crypto_mgr, docs, field_specs, executor, chunk_size, window, workers)
+
+
+def decrypt_docs(
+    crypto_mgr,  # type: Optional["CryptoManager"]
+    docs,  # type: Iterable[Dict]
+    field_specs,  # type: Union[FieldSpecs, List[dict]]
+    executor=None,  # type: Optional[Executor]
+    chunk_size=100,  # type: int
+    window=None,  # type: Optional[int]
+    workers=None,  # type: Optional[int]
+) -> Iterator[dict]:
+    """Decrypts the matching fields of every document in `docs`, yielding the decrypted documents in input order.
+
+    Takes the same arguments as `encrypt_docs`.
+
+    Returns:
+        Iterator[Dict]: The provided documents with previously encrypted fields decrypted.
+    """
+    return _crypt_docs(decrypt_doc, crypto_mgr, docs, field_specs, executor, chunk_size, window, workers)
+
+
+def crypto_process_pool(
+    crypto_mgr_factory,  # type: Callable[[], "CryptoManager"]
+    max_workers=None,  # type: Optional[int]
+) -> ProcessPoolExecutor:
+    """Creates a process pool for `encrypt_docs` and `decrypt_docs`, where each worker process creates its own crypto manager.
+
+    Encryption is CPU bound, so a process pool scales across cores where a thread pool is limited by the GIL.
+
+    Args:
+        crypto_mgr_factory (Callable): A module level function that creates and returns a crypto manager, with its
+            encrypters and decrypters registered
+        max_workers (int, optional): The number of worker processes, defaults to the number of CPUs.  Pass the same
+            number as `workers` to `encrypt_docs` and `decrypt_docs`.
+
+    Returns:
+        `concurrent.futures.ProcessPoolExecutor`: The process pool
+    """
+    return ProcessPoolExecutor(max_workers=max_workers,
+                               initializer=_init_crypto_worker,
+                               initargs=(crypto_mgr_factory,))
+
+
+_worker_crypto_mgr = None
+
+
+def _init_crypto_worker(crypto_mgr_factory):
+    global _worker_crypto_mgr
+    _worker_crypto_mgr = crypto_mgr_factory()
+
+
+def _crypt_chunk(crypt_fn, crypto_mgr, docs, field_specs):
+    if crypto_mgr is None:
+        crypto_mgr = _worker_crypto_mgr
+    if not isinstance(field_specs, FieldSpecs):
+        field_specs = FieldSpecs(crypto_mgr, field_specs)
+    return [crypt_fn(crypto_mgr, doc, field_specs) for doc in docs]
+
+
+def _crypt_docs(crypt_fn, crypto_mgr, docs, field_specs, executor, chunk_size, window, workers):
+    if crypto_mgr is not None and not isinstance(field_specs, FieldSpecs):
+        field_specs = FieldSpecs(crypto_mgr, field_specs)
+
+    if executor is None:
+        for doc in docs:
+            yield crypt_fn(crypto_mgr, doc, field_specs)
+        return
+
+    if window is None:
+        window = 2 * (workers or os.cpu_count() or 1)
+
+    docs = iter(docs)
+    pending = deque()
+    try:
+        while True:
+            chunk = list(islice(docs, chunk_size))
+            if not chunk:
+                break
+            pending.append(executor.submit(_crypt_chunk, crypt_fn, crypto_mgr, chunk, field_specs))
+            if len(pending) >= window:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        # the caller stopped early, don't leave queued chunks running
+        for fut in pending:
+            fut.cancel()
+# end::bulk_methods[]
@@ -1,19 +1,21 @@
 
 import traceback
-import functools
-import time
-from typing import Optional, Tuple, Callable
 import warnings
+from datetime import datetime, timedelta, timezone
 
 
 from couchbase.cluster import Cluster
 from couchbase.auth import PasswordAuthenticator
-from couchbase.collection import InsertOptions, ReplaceOptions
+from couchbase.collection import ReplaceOptions
 from couchbase.exceptions import (CASMismatchException, CouchbaseException,
                                   DocumentNotFoundException,
                                   DocumentExistsException,
-                                  DurabilitySyncWriteAmbiguousException, QueryErrorContext)
-from couchbase.durability import Durability, ServerDurability
+                                  QueryErrorContext)
+from couchbase.durability import Durability
+
+from cas_helpers import CasMetrics, mutate_with_cas
+from durable_writes import DurabilityLatencies, durable_write, durable_write_many
+from retry_policy import Jitter, RetryBudget, RetryPolicy, retry
 
 # ErrorContext is still uncommited in the Python SDK, ignore the runtime warnings for the example
 warnings.filterwarnings("ignore")
@@ -36,42 +38,24 @@ except CouchbaseException:
 
 
 # tag::retries[]
-def allow_retries(retry_limit=3,                # type: int
-                  backoff=1.0,                  # type: float
-                  exponential_backoff=False,    # type: bool
-                  linear_backoff=False,         # type: bool
-                  allowed_exceptions=None       # type: Optional[Tuple]
-                  ) -> Callable:
-    def handle_retries(func):
-        @functools.wraps(func)
-        def func_wrapper(*args, **kwargs):
-            for retry_num in reversed(range(retry_limit)):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as ex:
-                    if allowed_exceptions is None or not isinstance(ex, allowed_exceptions):
-                        raise
-
-                    if retry_num == 0:
-                        raise
-
-                    delay = backoff
-                    if exponential_backoff is True:
-                        delay *= (2**retry_num)
-                    elif linear_backoff is True:
-                        delay *= (retry_num+1)
-
-                    print(f"Retries left: {retry_num}")
-                    print(f"Backing Off: {delay} seconds")
-                    time.sleep(delay)
-
-        return func_wrapper
-    return handle_retries
-
-
-@allow_retries(retry_limit=5,
-               backoff=0.5,
-               allowed_exceptions=(CASMismatchException))
+# one retry budget shared by every operation against the cluster, so a
+# struggling cluster isn't hit by a storm of retries from this process
+retry_budget = RetryBudget(max_tokens=10, refill_per_second=2.0)
+
+
+def print_retry(attempt, ex, delay):
+    print(f"Attempt {attempt} failed: {type(ex).__name__}")
+    print(f"Backing Off: {delay:.3f} seconds")
+
+
+@retry(RetryPolicy(retry_limit=5,
+                   base_delay=timedelta(milliseconds=50),
+                   jitter=Jitter.DECORRELATED,
+                   allowed_exceptions=(CASMismatchException,),
+                   budget=retry_budget,
+                   # the default KV timeout, no retry is started after it
+                   timeout=timedelta(milliseconds=2500),
+                   on_retry=print_retry))
 def update_with_cas(collection,    # type: str
                     doc_key       # type: str
                     ) -> bool:
@@ -87,6 +71,21 @@ key = "hotel_10026"
 update_with_cas(collection, key)
 # end::retries[]
 
+# tag::mutate_with_cas[]
+cas_metrics = CasMetrics()
+
+
+def record_view(content):
+    content["views"] = content.get("views", 0) + 1
+    content["last_viewed"] = datetime.now(timezone.utc).isoformat()
+
+
+# only views and last_viewed change, so they are written with mutate_in
+# rather than replacing the whole hotel document
+mutate_with_cas(collection, "hotel_10026", record_view, metrics=cas_metrics)
+print(f"CAS contention: {cas_metrics.snapshot()}")
+# end::mutate_with_cas[]
+
 # tag::DocumentNotFoundException[]
 try:
     key = "not-a-key"
@@ -114,25 +113,28 @@ except CASMismatchException:
 # end::CASMismatchException[]
 
 # tag::DurabilitySyncWriteAmbiguousException[]
-for i in range(5):
-    try:
-        durability = ServerDurability(level=Durability.PERSIST_TO_MAJORITY)
-        collection.insert(
-            "my-key", {"title": "New Hotel"}, InsertOptions(durability=durability))
-    except (DocumentExistsException, DurabilitySyncWriteAmbiguousException,) as ex:
-        # if previously retried and the document now exists,
-        # we can assume it was written successfully by a previous ambiguous exception
-        if isinstance(ex, DocumentExistsException) and i > 0:
-            continue
-
-        # simply retry the durable operation again
-        if isinstance(ex, DurabilitySyncWriteAmbiguousException):
-            continue
-
-        # raise the exception if not DocumentExistsException, DurabilitySyncWriteAmbiguousException
-        raise
+durability_latencies = DurabilityLatencies()
+
+# an ambiguous outcome is resolved by reading the document back,
+# and the insert is only retried if it did not happen
+result = durable_write(collection, "my-key", {"title": "New Hotel"},
+                       level=Durability.PERSIST_TO_MAJORITY,
+                       latencies=durability_latencies)
+print(f"Durable write: {result}")
 # end::DurabilitySyncWriteAmbiguousException[]
 
+# tag::durable_write_many[]
+# compare the latency of each durability level over a batch of writes
+for level in (Durability.MAJORITY, Durability.PERSIST_TO_MAJORITY):
+    docs = {f"durable-{level.name}-{i}": {"title": "New Hotel", "number": i}
+            for i in range(50)}
+    durable_write_many(collection, docs, insert=False, level=level,
+                       latencies=durability_latencies)
+    collection.remove_multi(list(docs))
+
+print(f"Durable write latencies: {durability_latencies.snapshot()}")
+# end::durable_write_many[]
+
 # tag::QueryErrorContext[]
 try:
     cluster.query("SELECT * FROM no_such_bucket").rows()
@@ -2,6 +2,12 @@ from couchbase.cluster import Cluster
 from couchbase.auth import PasswordAuthenticator
 from couchbase.bucket import PingOptions
 from couchbase.diagnostics import PingState, ServiceType
+from datetime import timedelta
+from urllib.request import urlopen
+import time
+
+from health_exporter import MetricsExporter
+from health_monitor import HealthMonitor
 
 # tag::check_connection[]
 def ok(cluster):
@@ -53,3 +59,33 @@ print(diag_result.as_json())
 # end::cluster_diagnostics[]
 
 print("Cluster state: {}".format(diag_result.state))
+
+# tag::health_monitor_usage[]
+monitor = HealthMonitor(cluster, intervals={
+    ServiceType.KeyValue: timedelta(milliseconds=500),
+    ServiceType.Query: timedelta(seconds=1)
+})
+monitor.start()
+time.sleep(3)
+
+# cheap enough to call from every load balancer probe, it never pings the cluster
+print("Cluster is healthy? {}".format(monitor.is_healthy()))
+print("Key-value is healthy? {}".format(monitor.is_healthy(ServiceType.KeyValue)))
+for service, endpoints in monitor.histograms().items():
+    for remote, histogram in endpoints.items():
+        print("{0}: {1} p50 {2}ms, p99 {3}ms".format(
+            service, remote, histogram["p50_ms"], histogram["p99_ms"]))
+
+monitor.stop()
+# end::health_monitor_usage[]
+
+# tag::metrics_exporter_usage[]
+exporter = MetricsExporter(cluster, interval=timedelta(seconds=15), port=9091)
+exporter.start()
+
+# every scrape is served from memory, the cluster is only pinged every 15 seconds
+with urlopen("http://localhost:{}/metrics".format(exporter.port)) as response:
+    print(response.read().decode("utf-8"))
+
+exporter.stop()
+# end::metrics_exporter_usage[]
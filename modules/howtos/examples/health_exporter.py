@@ -0,0 +1,189 @@
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from couchbase.diagnostics import ClusterState, PingState
+from couchbase.exceptions import CouchbaseException
+
+
+# tag::render_metrics[]
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    if labels:
+        label_str = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items())
+        return '{}{{{}}} {}'.format(name, label_str, value)
+    return '{} {}'.format(name, value)
+
+
+def render_metrics(ping_result,
+                   diag_result,
+                   ping_totals,         # type: Dict[Tuple[str, str], int]
+                   refresh_errors=0,    # type: int
+                   refreshed_at=None    # type: Optional[float]
+                   ) -> bytes:
+    """Renders a ping and a diagnostics result in the Prometheus text exposition format.
+
+    Args:
+        ping_result (`couchbase.result.PingResult`): The result of `cluster.ping()`
+        diag_result (`couchbase.result.DiagnosticsResult`): The result of `cluster.diagnostics()`
+        ping_totals (Dict): The number of pings so far, by (service, state)
+        refresh_errors (int): The number of times the cluster couldn't be pinged
+        refreshed_at (float, optional): The unix time of the results
+
+    Returns:
+        bytes: The metrics, ready to be served
+    """
+    lines = []  # type: List[str]
+
+    def family(name, kind, help_text, samples):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.extend(_sample(name, labels, value) for labels, value in samples)
+
+    ping_latencies = []
+    ping_up = []
+    if ping_result is not None:
+        for service, reports in ping_result.endpoints.items():
+            for report in reports:
+                labels = {'service': service.value, 'remote': report.remote}
+                ping_up.append((labels, 1 if report.state == PingState.OK else 0))
+                if report.latency is not None:
+                    ping_latencies.append((labels, report.latency.total_seconds()))
+    family('couchbase_ping_latency_seconds', 'gauge',
+           'Latency of the most recent ping of each endpoint.', ping_latencies)
+    family('couchbase_ping_up', 'gauge',
+           'Whether the most recent ping of each endpoint succeeded.', ping_up)
+    family('couchbase_ping_total', 'counter', 'Pings sent, by service and result.',
+           [({'service': service, 'state': state}, count)
+            for (service, state), count in sorted(ping_totals.items())])
+
+    connections = Counter()
+    if diag_result is not None:
+        for service, reports in diag_result.endpoints.items():
+            for report in reports:
+                connections[(service.value, report.state.value)] += 1
+    family('couchbase_connections', 'gauge', 'Connections, by service and state.',
+           [({'service': service, 'state': state}, count)
+            for (service, state), count in sorted(connections.items())])
+    if diag_result is not None:
+        family('couchbase_cluster_state', 'gauge',
+               'The state of the cluster, as seen by the client.',
+               [({'state': state.value}, 1 if diag_result.state == state else 0)
+                for state in ClusterState])
+
+    family('couchbase_exporter_refresh_errors_total', 'counter',
+           'Times the cluster could not be pinged.', [({}, refresh_errors)])
+    if refreshed_at is not None:
+        family('couchbase_exporter_last_refresh_timestamp_seconds', 'gauge',
+               'When the metrics were last refreshed.', [({}, refreshed_at)])
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
+# end::render_metrics[]
+
+
+# tag::metrics_exporter[]
+class MetricsExporter(object):
+    """Serves ping and diagnostics metrics of a cluster for Prometheus to scrape.
+
+    A background thread pings the cluster every `interval` and renders the metrics
+    once; every scrape serves the most recently rendered bytes.  However often,
+    and by however many scrapers, the metrics are scraped, the cluster is only
+    pinged once per interval.
+
+    Args:
+        cluster (`couchbase.cluster.Cluster`): The cluster to export metrics for
+        interval (timedelta): How often to refresh the metrics
+        host (str): The address to serve the metrics on
+        port (int): The port to serve the metrics on, 0 picks a free port
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self,
+                 cluster,
+                 interval=timedelta(seconds=15),    # type: timedelta
+                 host='0.0.0.0',                    # type: str
+                 port=9091                          # type: int
+                 ):
+        self._cluster = cluster
+        self._interval = interval.total_seconds()
+        self._ping_totals = Counter()
+        self._refresh_errors = 0
+        # replaced as a whole by the refresh thread, so scrapes never need a lock
+        self._payload = render_metrics(None, None, self._ping_totals)
+        self._stop = threading.Event()
+        self._refresher = None
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._server_thread = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        # serve fresh metrics from the first scrape
+        self.refresh()
+        self._refresher = threading.Thread(target=self._refresh_loop,
+                                           name='metrics-refresh', daemon=True)
+        self._refresher.start()
+        self._server_thread = threading.Thread(target=self._server.serve_forever,
+                                               name='metrics-server', daemon=True)
+        self._server_thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._server.shutdown()
+        self._server.server_close()
+        for thread in (self._refresher, self._server_thread):
+            if thread is not None:
+                thread.join()
+
+    def scrape(self) -> bytes:
+        return self._payload
+
+    def refresh(self):
+        try:
+            ping_result = self._cluster.ping()
+            diag_result = self._cluster.diagnostics()
+        except CouchbaseException:
+            self._refresh_errors += 1
+            ping_result = diag_result = None
+        else:
+            for service, reports in ping_result.endpoints.items():
+                for report in reports:
+                    self._ping_totals[(service.value, report.state.value)] += 1
+        self._payload = render_metrics(ping_result, diag_result, self._ping_totals,
+                                       self._refresh_errors, time.time())
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self._interval):
+            self.refresh()
+
+    def _handler(self):
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = exporter.scrape()
+                self.send_response(200)
+                self.send_header('Content-Type', MetricsExporter.CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                # scrapes are frequent, don't log every one of them
+                pass
+
+        return MetricsHandler
+# end::metrics_exporter[]
@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Dict, Optional
+
+from couchbase.bucket import PingOptions
+from couchbase.diagnostics import PingState, ServiceType
+from couchbase.exceptions import CouchbaseException
+
+from metrics_helpers import nearest_rank
+
+
+# tag::latency_histogram[]
+class LatencyHistogram(object):
+    """Rolling histogram of the most recent `window` latencies of one endpoint.
+
+    Only the monitor thread for the endpoint's service adds samples; readers take a
+    copy of the samples, so neither side needs a lock.
+    """
+
+    # upper bounds of the buckets, in milliseconds
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self, window=100):
+        self._samples = deque(maxlen=window)
+
+    def add(self, latency):
+        self._samples.append(latency.total_seconds() * 1000)
+
+    def buckets(self) -> Dict[str, int]:
+        samples = list(self._samples)
+        counts = {'<={}ms'.format(bound): 0 for bound in self.BUCKETS}
+        counts['>{}ms'.format(self.BUCKETS[-1])] = 0
+        for ms in samples:
+            bound = next((b for b in self.BUCKETS if ms <= b), None)
+            counts['<={}ms'.format(bound) if bound else '>{}ms'.format(self.BUCKETS[-1])] += 1
+        return counts
+
+    def percentile(self, p) -> Optional[float]:
+        samples = sorted(self._samples)
+        if not samples:
+            return None
+        return nearest_rank(samples, p)
+# end::latency_histogram[]
+
+
+# tag::health_monitor[]
+class HealthMonitor(object):
+    """Pings each service of a cluster on its own schedule, in the background.
+
+    `is_healthy()` only reads the result of the most recent pings, so load
+    balancer probes can call it as often as they like without pinging the cluster.
+
+    Args:
+        cluster (`couchbase.cluster.Cluster`): The cluster to monitor
+        intervals (Dict[`ServiceType`, timedelta]): How often to ping each service
+        window (int): How many recent latencies to keep per endpoint
+        stale_after (int): A service is unhealthy if it hasn't been pinged
+            successfully in this many intervals
+    """
+
+    def __init__(self,
+                 cluster,
+                 intervals=None,    # type: Optional[Dict[ServiceType, timedelta]]
+                 window=100,        # type: int
+                 stale_after=3      # type: int
+                 ):
+        self._cluster = cluster
+        self._intervals = intervals or {
+            ServiceType.KeyValue: timedelta(seconds=5),
+            ServiceType.Query: timedelta(seconds=15),
+            ServiceType.Search: timedelta(seconds=30),
+        }
+        self._window = window
+        self._stale_after = stale_after
+        # every service has its own entry, written only by its own thread, so
+        # updates never race and readers see either the old or the new value
+        self._health = {service: (False, 0.0) for service in self._intervals}
+        self._histograms = {service: {} for service in self._intervals}
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for service, interval in self._intervals.items():
+            thread = threading.Thread(target=self._monitor,
+                                      args=(service, interval.total_seconds()),
+                                      name='health-monitor-{}'.format(service.value),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def is_healthy(self, service=None) -> bool:
+        services = [service] if service is not None else self._intervals
+        now = time.monotonic()
+        for svc in services:
+            ok, checked_at = self._health[svc]
+            max_age = self._stale_after * self._intervals[svc].total_seconds()
+            if not ok or now - checked_at > max_age:
+                return False
+        return True
+
+    def histograms(self) -> Dict[str, Dict[str, Dict]]:
+        snapshot = {}
+        for service, endpoints in self._histograms.items():
+            snapshot[service.value] = {
+                remote: {
+                    'p50_ms': hist.percentile(50),
+                    'p99_ms': hist.percentile(99),
+                    'buckets': hist.buckets()
+                } for remote, hist in list(endpoints.items())}
+        return snapshot
+
+    def _monitor(self, service, interval):
+        while True:
+            self._ping(service)
+            if self._stop.wait(interval):
+                return
+
+    def _ping(self, service):
+        try:
+            result = self._cluster.ping(PingOptions(service_types=[service]))
+        except CouchbaseException:
+            self._health[service] = (False, time.monotonic())
+            return
+
+        # a service with no endpoints to ping isn't available either
+        ok = any(result.endpoints.values())
+        endpoints = self._histograms[service]
+        for reports in result.endpoints.values():
+            for report in reports:
+                if report.state != PingState.OK:
+                    ok = False
+                    continue
+                hist = endpoints.get(report.remote)
+                if hist is None:
+                    hist = endpoints[report.remote] = LatencyHistogram(self._window)
+                hist.add(report.latency)
+        self._health[service] = (ok, time.monotonic())
+# end::health_monitor[]
@@ -0,0 +1,17 @@
+import math
+from typing import Any, Sequence
+
+
+# tag::metrics_helpers[]
+def nearest_rank(values,  # type: Sequence[Any]
+                 p        # type: float
+                 ) -> Any:
+    """Returns the `p`th percentile of `values`, which must be sorted and not empty, by the nearest-rank method."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def collapse_whitespace(statement  # type: str
+                        ) -> str:
+    """Collapses the whitespace in a statement, so the same statement laid out differently is treated as one."""
+    return ' '.join(statement.split())
+# end::metrics_helpers[]
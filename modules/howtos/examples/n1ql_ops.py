@@ -1,7 +1,13 @@
 import uuid
+from datetime import timedelta
 
 from couchbase.mutation_state import MutationState
 from couchbase.cluster import QueryScanConsistency
+
+from query_streaming import PrefetchingRowReader, iter_row_chunks, stream_json
+from query_cache import QueryResultCache
+from query_metrics import QueryMetricsCollector
+from statement_registry import StatementRegistry
 # tag::n1ql_basic_example[]
 from couchbase.cluster import Cluster
 from couchbase.options import ClusterOptions, QueryOptions
@@ -124,3 +130,120 @@ result = agent_scope.query(
         "SELECT a.* FROM `airline` a WHERE a.country=$country LIMIT 10",
         country='France')
 # end::scope[]
+
+# tag::row_chunks[]
+result = cluster.query(
+    "SELECT a.* FROM `travel-sample`.inventory.airport a")
+
+# rows are read from the result as each chunk is consumed, so only one
+# chunk of rows is in memory at a time, however large the result is
+for chunk in iter_row_chunks(result, chunk_size=500):
+    print(f"Processing {len(chunk)} airports")
+# end::row_chunks[]
+
+# tag::prefetching_row_reader[]
+result = cluster.query(
+    "SELECT r.* FROM `travel-sample`.inventory.route r")
+
+# the next chunks are read while this one is processed, but never more than
+# 4 chunks ahead: a slow consumer holds back the query instead of buffering rows
+with PrefetchingRowReader(result, chunk_size=500, max_chunks=4) as reader:
+    for chunk in reader:
+        print(f"Processing {len(chunk)} routes")
+# end::prefetching_row_reader[]
+
+# tag::stream_json[]
+result = cluster.query(
+    "SELECT a.airportname FROM `travel-sample`.inventory.airport a LIMIT 5")
+
+# writes the JSON document piece by piece, e.g. as a streamed HTTP response
+for piece in stream_json(result, extra={"context": ["airports"]}):
+    print(piece, end="")
+print()
+# end::stream_json[]
+
+# tag::statement_registry[]
+statements = StatementRegistry(prepare_after=2)
+
+# the same parameterized statement, run for different cities: the first two
+# runs are ad hoc, after that the statement is prepared and its plan reused
+for city in ["San Jose", "Paris", "London", "Tokyo", "Berlin"]:
+    result = statements.query(
+        cluster,
+        "SELECT a.airportname FROM `travel-sample`.inventory.airport a WHERE a.city=$1",
+        QueryOptions(positional_parameters=[city]))
+    for row in result:
+        print(f"Found airport: {row}")
+
+# scopes can run their queries through the registry too
+for country in ["France", "United States"]:
+    result = statements.query(
+        agent_scope, "SELECT a.name FROM `airline` a WHERE a.country=$country LIMIT 10",
+        country=country)
+    rows = list(result)
+
+for entry in statements.report():
+    print("{0} runs ({1} prepared), mean {2}: {3}".format(
+        entry["executions"], entry["prepared_executions"],
+        entry["mean_execution_time"], entry["statement"]))
+    for recommendation in entry["recommendations"]:
+        print(f"  consider: {recommendation}")
+# end::statement_registry[]
+
+# tag::query_cache[]
+query_cache = QueryResultCache(max_entries=1000, ttl=timedelta(minutes=5))
+
+AIRLINES = "travel-sample.inventory.airline"
+by_callsign = "SELECT a.name FROM `travel-sample`.inventory.airline a WHERE a.callsign=$1"
+
+# the first lookup runs the query, the second is served from the cache
+for _ in range(2):
+    rows = query_cache.query(cluster, by_callsign,
+                             QueryOptions(positional_parameters=["TXW"]),
+                             keyspaces=[AIRLINES])
+    print(f"Airlines with callsign TXW: {rows}")
+
+# writing to the keyspace drops the cached results which read it...
+airline_collection = bucket.scope("inventory").collection("airline")
+res = airline_collection.upsert("airline_987654321", {
+    "callsign": "TXW",
+    "country": "United States",
+    "id": 987654321,
+    "name": "Texan Wings",
+    "type": "airline"
+})
+query_cache.record_mutation(res, AIRLINES)
+
+# ...and the next lookup waits for the index to include the write, so it sees it
+rows = query_cache.query(cluster, by_callsign,
+                         QueryOptions(positional_parameters=["TXW"]),
+                         keyspaces=[AIRLINES])
+print(f"Airlines with callsign TXW: {rows}")
+print(f"Cache stats: {query_cache.stats()}")
+# end::query_cache[]
+
+# tag::query_metrics[]
+query_metrics = QueryMetricsCollector(max_samples=1000)
+
+for limit in [5, 50, 500]:
+    # inlined values are normalized away, so these are all one statement
+    result = query_metrics.query(
+        cluster, f"SELECT r.* FROM `travel-sample`.inventory.route r LIMIT {limit}")
+    rows = list(result)
+
+for city in ["San Jose", "Paris", "London"]:
+    result = query_metrics.query(
+        cluster,
+        "SELECT a.airportname FROM `travel-sample`.inventory.airport a WHERE a.city=$1",
+        QueryOptions(positional_parameters=[city]))
+    rows = list(result)
+
+# one line per statement, slowest first
+for line in query_metrics.report():
+    print(line)
+
+# or the full percentiles, e.g. to serve from a dashboard endpoint
+for statement, entry in query_metrics.snapshot().items():
+    print(f"{statement}: execution p99 {entry['execution_time'][99]}, "
+          f"slowest query {entry['slowest_client_context_id']}")
+# end::query_metrics[]
@@ -1,6 +1,7 @@
 from datetime import timedelta
 import logging
 import sys
+import time
 
 import couchbase
 from couchbase.cluster import Cluster
@@ -8,6 +9,8 @@ from couchbase.options import ClusterOptions, ClusterTracingOptions
 from couchbase.auth import PasswordAuthenticator
 from couchbase.exceptions import UnAmbiguousTimeoutException
 
+from orphan_tracker import OrphanTracker
+
 # tag::orphan_logging_config[]
 # configure logging
 logging.basicConfig(filename='example.log',
@@ -20,8 +23,8 @@ logger = logging.getLogger()
 couchbase.configure_logging(logger.name, level=logger.level)
 
 tracing_opts = ClusterTracingOptions(
-    # report interval
-    tracing_orphaned_queue_flush_interval=timedelta(minutes=1),
+    # report interval, short so this example sees a report before it ends
+    tracing_orphaned_queue_flush_interval=timedelta(seconds=10),
     # sample size
     tracing_orphaned_queue_size=10
 )
@@ -30,6 +33,15 @@ authenticator = PasswordAuthenticator("Administrator", "password")
 
 cluster = Cluster("couchbase://your-ip", ClusterOptions(authenticator,tracing_options=tracing_opts))
 # end::orphan_logging_config[]
+
+# tag::orphan_tracker_config[]
+# count orphans over the last 5 minutes, and raise the timeout of gets when
+# too many responses arrive after the client gave up on them
+orphan_tracker = OrphanTracker(timeouts={"get": timedelta(milliseconds=2500)},
+                               window=timedelta(minutes=5),
+                               auto_apply=True)
+logger.addHandler(orphan_tracker)
+# end::orphan_tracker_config[]
 collection = cluster.bucket("beer-sample").default_collection()
 
 for _ in range(100):
@@ -39,3 +51,22 @@ for _ in range(100):
             microseconds=1))
     except UnAmbiguousTimeoutException:
         pass
+
+# wait for the orphan report to be logged at the end of the interval
+time.sleep(11)
+
+# tag::orphan_tracker_usage[]
+# reports are logged at the end of each report interval, so this may be empty
+# when the script runs for less than one interval
+for service, summary in orphan_tracker.summary().items():
+    # counts every orphan, not just the sampled ones
+    print("{0}: {1} orphans ({2:.1f}/min)".format(service, summary["count"], summary["per_minute"]))
+    for remote, operations in summary["sampled"].items():
+        for operation, sampled in operations.items():
+            print("  {0} {1}: {2} sampled, server p99 {3}us, timeout {4}ms".format(
+                remote, operation, sampled["count"], sampled["server_us"].get(99), sampled["timeout_ms"]))
+print("Recommended get timeout: {}".format(orphan_tracker.recommend_timeout("get")))
+
+# the options follow the recommendation, as auto_apply is set
+result = collection.get("21st_amendment_brewery_cafe", orphan_tracker.get_options())
+# end::orphan_tracker_usage[]
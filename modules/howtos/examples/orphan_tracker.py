@@ -0,0 +1,151 @@
+import logging
+import time
+from collections import Counter, deque
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from couchbase.options import GetOptions
+
+from metrics_helpers import nearest_rank
+from slow_ops_analyzer import ORPHAN, parse_sdk_report
+
+
+# tag::orphan_tracker[]
+class OrphanTracker(logging.Handler):
+    """Logging handler which tracks orphaned responses, and recommends timeouts from them.
+
+    An orphaned response is one the server sent after the client had already given up on the
+    operation: the server did the work, but nobody used the result.  Every orphan report the
+    SDK logs is parsed.  The `total_count` of each service in the report counts every orphan,
+    and gives the rate of orphans over the last `window`.  The report only lists a sample of
+    the orphans, up to the orphan queue size, and the sampled orphans of the last `window`
+    are kept per endpoint and operation, for their durations.
+
+    From the total durations of the sampled orphans, the time from sending the request to the
+    late response arriving, the tracker recommends a timeout for each operation which would
+    have seen `percentile` percent of them complete, with some `headroom`.  The total rather
+    than the server duration is used, as the timeout also has to cover the time on the
+    network and in the queues.  With `auto_apply`, the recommendation replaces the operation's
+    timeout once at least `min_orphans` sampled orphans have been seen in the window, so the
+    options returned by `get_options()` follow it.
+
+    Args:
+        timeouts (Dict[str, timedelta]): The timeout currently used for each operation, e.g. {'get': ...}
+        window (timedelta): How long orphans are counted for
+        percentile (int): The percentile of orphan durations the recommended timeout should cover
+        headroom (float): The recommended timeout is the percentile multiplied by this
+        max_timeout (timedelta): The longest timeout to ever recommend
+        min_orphans (int): How many orphans of an operation there must be before recommending a timeout
+        auto_apply (bool): Replace the timeouts with the recommended ones
+    """
+
+    def __init__(self,
+                 timeouts=None,                        # type: Optional[Dict[str, timedelta]]
+                 window=timedelta(minutes=5),          # type: timedelta
+                 percentile=99,                        # type: int
+                 headroom=1.5,                         # type: float
+                 max_timeout=timedelta(seconds=10),    # type: timedelta
+                 min_orphans=10,                       # type: int
+                 auto_apply=False                      # type: bool
+                 ):
+        super().__init__()
+        self._timeouts = dict(timeouts or {'get': timedelta(milliseconds=2500)})
+        self._window = window.total_seconds()
+        self._percentile = percentile
+        self._headroom = headroom
+        self._max_timeout = max_timeout
+        self._min_orphans = min_orphans
+        self._auto_apply = auto_apply
+        # (seen at, service, total count), for every orphan reported
+        self._totals = deque()
+        # (seen at, service, remote, operation, total duration us, server duration us, timeout ms),
+        # for the sampled orphans
+        self._orphans = deque()
+
+    def emit(self, record):
+        kind, report = parse_sdk_report(record.getMessage())
+        if kind != ORPHAN:
+            return
+        now = time.monotonic()
+        # logging.Handler.handle() holds self.lock around emit()
+        for service, service_report in report.items():
+            if not isinstance(service_report, dict):
+                continue
+            top_requests = service_report.get('top_requests', [])
+            self._totals.append((now, service, service_report.get('total_count', len(top_requests))))
+            for entry in top_requests:
+                self._orphans.append((now,
+                                      service,
+                                      entry.get('last_remote_socket', 'unknown'),
+                                      entry.get('operation_name', 'unknown'),
+                                      entry.get('total_duration_us'),
+                                      entry.get('last_server_duration_us'),
+                                      entry.get('timeout_ms')))
+        self._expire(now)
+        if self._auto_apply:
+            for operation in {orphan[3] for orphan in self._orphans}:
+                recommended = self._recommend(operation)
+                if recommended is not None:
+                    self._timeouts[operation] = recommended
+
+    def timeout(self, operation='get') -> Optional[timedelta]:
+        with self.lock:
+            return self._timeouts.get(operation)
+
+    def get_options(self) -> GetOptions:
+        """Returns `GetOptions` with the current timeout for `get`, which follows the recommendation
+        when `auto_apply` is set."""
+        timeout = self.timeout('get')
+        return GetOptions(timeout=timeout) if timeout is not None else GetOptions()
+
+    def recommend_timeout(self, operation='get') -> Optional[timedelta]:
+        """Returns the recommended timeout for an operation, or None if there aren't enough orphans
+        to recommend one."""
+        with self.lock:
+            self._expire(time.monotonic())
+            return self._recommend(operation)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Returns, for each service, the number of orphans in the window and the rate per minute,
+        and, by endpoint and operation, the number of sampled orphans, their server duration
+        percentiles, and the timeout in use."""
+        with self.lock:
+            self._expire(time.monotonic())
+            totals = list(self._totals)
+            orphans = list(self._orphans)
+            timeouts = dict(self._timeouts)
+        minutes = self._window / 60
+        result = {}
+        for _, service, count in totals:
+            entry = result.setdefault(service, {'count': 0, 'per_minute': 0.0, 'sampled': {}})
+            entry['count'] += count
+            entry['per_minute'] = entry['count'] / minutes
+        samples = Counter((service, remote, operation) for _, service, remote, operation, _, _, _ in orphans)
+        for (service, remote, operation), count in sorted(samples.items()):
+            matching = [o for o in orphans if o[1:4] == (service, remote, operation)]
+            server_us = sorted(o[5] for o in matching if o[5] is not None)
+            timeout_ms = {o[6] for o in matching if o[6] is not None}
+            result[service]['sampled'].setdefault(remote, {})[operation] = {
+                'count': count,
+                'server_us': {p: nearest_rank(server_us, p) for p in (50, 99)} if server_us else {},
+                'timeout_ms': sorted(timeout_ms) or (
+                    [timeouts[operation].total_seconds() * 1000] if operation in timeouts else [])
+            }
+        return result
+
+    def _expire(self, now):
+        while self._totals and now - self._totals[0][0] > self._window:
+            self._totals.popleft()
+        while self._orphans and now - self._orphans[0][0] > self._window:
+            self._orphans.popleft()
+
+    def _recommend(self, operation):
+        durations = sorted(o[4] for o in self._orphans if o[3] == operation and o[4] is not None)
+        if len(durations) < self._min_orphans:
+            return None
+        recommended = timedelta(microseconds=nearest_rank(durations, self._percentile) * self._headroom)
+        recommended = min(recommended, self._max_timeout)
+        current = self._timeouts.get(operation)
+        # orphans only say that timeouts are too short, never that they are too long
+        return max(recommended, current) if current is not None else recommended
+# end::orphan_tracker[]
@@ -0,0 +1,159 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, Iterable, List
+
+from couchbase.mutation_state import MutationState
+
+from metrics_helpers import collapse_whitespace
+
+
+# tag::query_cache[]
+ANY_KEYSPACE = '*'
+
+
+class QueryResultCache(object):
+    """An opt-in cache of query results, with read-your-own-writes after invalidation.
+
+    Results are cached by the statement, with its whitespace normalized, and by every
+    parameter and option it was run with, for at most `ttl`, in an LRU of `max_entries`
+    results.  Only results of up to `max_rows` rows are cached, as the rows are held in
+    memory: the cache is meant for small, hot lookups, not for reports.
+
+    Every write which should be visible to cached queries is passed to `record_mutation`,
+    with the keyspace it wrote to.  That drops the cached results of queries which read the
+    keyspace, and the next run of each of those queries is made with `consistent_with` the
+    writes, so it sees them even though the index may not have caught up yet.
+
+    Args:
+        max_entries (int): The most results to cache
+        ttl (timedelta): How long a result is cached for
+        max_rows (int): The most rows a result can have and still be cached
+    """
+
+    def __init__(self,
+                 max_entries=1000,              # type: int
+                 ttl=timedelta(seconds=30),     # type: timedelta
+                 max_rows=1000                  # type: int
+                 ):
+        self._max_entries = max_entries
+        self._ttl = ttl.total_seconds()
+        self._max_rows = max_rows
+        # key -> (expires at, rows, keyspaces)
+        self._entries = OrderedDict()
+        # keyspace -> mutation results not yet known to be indexed
+        self._pending = {}
+        # keyspace -> number of writes recorded to it
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def query(self,
+              target,                       # type: Any
+              statement,                    # type: str
+              *options,                     # type: Any
+              keyspaces=(ANY_KEYSPACE,),    # type: Iterable[str]
+              **kwargs                      # type: Any
+              ) -> List[Any]:
+        """Runs `statement` with `target.query()`, where `target` is a `Cluster` or a `Scope`,
+        unless its result is cached.
+
+        Takes the same arguments as `query()`, and `keyspaces`, the keyspaces the statement reads,
+        e.g. ('travel-sample.inventory.airport',).  By default, a write to any keyspace drops the result.
+
+        Returns:
+            List: The rows of the result
+        """
+        keyspaces = frozenset(keyspaces)
+        key = self._key(target, statement, options, kwargs)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(entry[1])
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            generations = self._generations_read(keyspaces)
+            pending = {ks: list(results) for ks, results in self._pending.items()
+                       if self._depends(keyspaces, ks)}
+
+        mutations = [result for results in pending.values() for result in results]
+        if mutations:
+            kwargs['consistent_with'] = MutationState(*mutations)
+        rows = list(target.query(statement, *options, **kwargs).rows())
+
+        with self._lock:
+            # the index has caught up with these writes, later queries needn't wait for them
+            for ks, results in pending.items():
+                indexed = {id(result) for result in results}
+                remaining = [r for r in self._pending.get(ks, []) if id(r) not in indexed]
+                if remaining:
+                    self._pending[ks] = remaining
+                else:
+                    self._pending.pop(ks, None)
+            # don't cache a result which may have missed a write made while it ran,
+            # writes to keyspaces the statement doesn't read don't matter
+            if generations == self._generations_read(keyspaces) and len(rows) <= self._max_rows:
+                self._entries[key] = (time.monotonic() + self._ttl, rows, keyspaces)
+                self._entries.move_to_end(key)
+                if len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return list(rows)
+
+    def record_mutation(self,
+                        result,                 # type: Any
+                        keyspace=ANY_KEYSPACE   # type: str
+                        ):
+        """Drops the cached results which read `keyspace`, and makes the next queries of it consistent
+        with the write.
+
+        Args:
+            result (`couchbase.result.MutationResult`): The result of the write
+            keyspace (str): The keyspace written to, e.g. 'travel-sample.inventory.airport'
+        """
+        with self._lock:
+            self._generations[keyspace] = self._generations.get(keyspace, 0) + 1
+            self._pending.setdefault(keyspace, []).append(result)
+            stale = [key for key, (_, _, keyspaces) in self._entries.items()
+                     if self._depends(keyspaces, keyspace)]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+    def _generations_read(self, keyspaces):
+        # holds self._lock
+        return {ks: generation for ks, generation in self._generations.items()
+                if self._depends(keyspaces, ks)}
+
+    @staticmethod
+    def _depends(keyspaces, keyspace):
+        return keyspace == ANY_KEYSPACE or ANY_KEYSPACE in keyspaces or keyspace in keyspaces
+
+    @staticmethod
+    def _key(target, statement, options, kwargs):
+        # a scope's queries run in the scope's query context
+        context = (type(target).__name__,
+                   getattr(target, 'bucket_name', None),
+                   getattr(target, 'name', None))
+        params = json.dumps([list(options), kwargs], sort_keys=True, default=str)
+        return context, collapse_whitespace(statement), params
+# end::query_cache[]
@@ -0,0 +1,151 @@
+import re
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from datetime import timedelta
+from typing import Any, Dict, List
+
+from metrics_helpers import collapse_whitespace, nearest_rank
+from statement_registry import TrackedQueryResult
+
+
+# tag::query_metrics[]
+QuerySample = namedtuple('QuerySample', ['client_context_id', 'client_time', 'elapsed_time',
+                                         'execution_time', 'result_count', 'result_size'])
+
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_LITERAL = re.compile(r'(?<![\w`$])-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?(?![\w`])')
+
+
+def normalize_statement(statement  # type: str
+                        ) -> str:
+    """Replaces the literals in a statement with `?` and collapses its whitespace, so runs of the
+    same statement with different inlined values are grouped together."""
+    statement = _STRING_LITERAL.sub('?', statement)
+    statement = _NUMBER_LITERAL.sub('?', statement)
+    return collapse_whitespace(statement)
+
+
+class QueryMetricsCollector(object):
+    """Runs SQL++ queries with `metrics=True`, and keeps their metrics, by normalized statement.
+
+    For each query, once its rows have been read, the collector records the time the client
+    spent on it, from sending the query to reading the last row, along with the server's
+    `elapsed_time`, `execution_time`, `result_count` and `result_size`, and the query's
+    `client_context_id`, which identifies it in `system:completed_requests`.
+
+    A query whose execution time is most of its client time is bound by the server: the
+    statement, or its indexes, need work.  When the client time is much longer, the time goes
+    on the network, or on the application reading the rows.
+
+    Args:
+        max_samples (int): How many recent queries to keep per statement
+        max_statements (int): The most statements to keep, the least recently run are dropped
+        server_bound_ratio (float): A query is server bound if its execution time is at least
+            this fraction of its client time
+    """
+
+    def __init__(self,
+                 max_samples=1000,          # type: int
+                 max_statements=500,        # type: int
+                 server_bound_ratio=0.8     # type: float
+                 ):
+        self._max_samples = max_samples
+        self._max_statements = max_statements
+        self._server_bound_ratio = server_bound_ratio
+        self._samples = OrderedDict()
+        self._lock = threading.Lock()
+
+    def query(self,
+              target,       # type: Any
+              statement,    # type: str
+              *options,     # type: Any
+              **kwargs      # type: Any
+              ):
+        """Runs `statement` with `target.query()`, where `target` is a `Cluster` or a `Scope`.
+
+        Takes the same arguments as `query()`, and returns its result, which records the
+        metrics of the query once all its rows have been read.
+        """
+        # keyword arguments take precedence over the QueryOptions passed in
+        kwargs['metrics'] = True
+        start = time.perf_counter()
+        result = target.query(statement, *options, **kwargs)
+        return MeteredQueryResult(result, self, normalize_statement(statement), start)
+
+    def record(self, statement, sample):
+        with self._lock:
+            samples = self._samples.get(statement)
+            if samples is None:
+                samples = self._samples[statement] = deque(maxlen=self._max_samples)
+                if len(self._samples) > self._max_statements:
+                    self._samples.popitem(last=False)
+            else:
+                self._samples.move_to_end(statement)
+            samples.append(sample)
+
+    def is_server_bound(self, sample) -> bool:
+        return sample.execution_time >= self._server_bound_ratio * sample.client_time
+
+    def snapshot(self, percentiles=(50, 95, 99)) -> Dict[str, Dict[str, Any]]:
+        """Returns, for each statement, the percentiles of each metric, how many of its queries were
+        server bound, and the client context ID of its slowest query."""
+        with self._lock:
+            samples_by_statement = {statement: list(samples)
+                                    for statement, samples in self._samples.items()}
+        snapshot = {}
+        for statement, samples in samples_by_statement.items():
+            server_bound = sum(1 for s in samples if self.is_server_bound(s))
+            slowest = max(samples, key=lambda s: s.client_time)
+            entry = {
+                'count': len(samples),
+                'server_bound': server_bound / len(samples),
+                'slowest_client_context_id': slowest.client_context_id
+            }
+            for field in ('client_time', 'elapsed_time', 'execution_time', 'result_count', 'result_size'):
+                values = sorted(getattr(s, field) for s in samples)
+                entry[field] = {p: nearest_rank(values, p) for p in percentiles}
+            snapshot[statement] = entry
+        return snapshot
+
+    def report(self, top=10) -> List[str]:
+        """Returns a line per statement, for the `top` statements by p95 client time."""
+        snapshot = self.snapshot()
+        ranked = sorted(snapshot.items(), key=lambda item: item[1]['client_time'][95], reverse=True)
+        lines = []
+        for statement, entry in ranked[:top]:
+            lines.append('{0:>6} runs  client p50 {1:>8.1f}ms p95 {2:>8.1f}ms  '
+                         'execution p95 {3:>8.1f}ms  {4:>4.0%} server bound  {5}'.format(
+                             entry['count'],
+                             _ms(entry['client_time'][50]),
+                             _ms(entry['client_time'][95]),
+                             _ms(entry['execution_time'][95]),
+                             entry['server_bound'],
+                             statement))
+        return lines
+
+
+class MeteredQueryResult(TrackedQueryResult):
+    """Wraps a query result, recording a `QuerySample` in the `QueryMetricsCollector` once its rows have been read."""
+
+    def __init__(self, result, collector, statement, start):
+        super().__init__(result, collector, statement)
+        self._start = start
+
+    def record(self, metadata):
+        client_time = timedelta(seconds=time.perf_counter() - self._start)
+        metrics = metadata.metrics()
+        if metrics is None:
+            return
+        # the registry is the collector, and the stats are the normalized statement
+        self._registry.record(self._stats, QuerySample(metadata.client_context_id(),
+                                                       client_time,
+                                                       metrics.elapsed_time(),
+                                                       metrics.execution_time(),
+                                                       metrics.result_count(),
+                                                       metrics.result_size()))
+
+
+def _ms(value):
+    return value.total_seconds() * 1000
+# end::query_metrics[]
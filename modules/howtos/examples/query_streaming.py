@@ -0,0 +1,168 @@
+import json
+import queue
+import threading
+from typing import (Any, AsyncIterable, AsyncIterator, Callable, Dict,
+                    Iterable, Iterator, List, Optional)
+
+
+# tag::row_chunks[]
+def iter_row_chunks(rows,           # type: Iterable[Any]
+                    chunk_size=100  # type: int
+                    ) -> Iterator[List[Any]]:
+    """Yields the rows of a query result in lists of at most `chunk_size` rows.
+
+    Rows are read from the result as the chunks are consumed, so at most one chunk
+    is held in memory, however many rows the query returns.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def aiter_row_chunks(rows,            # type: AsyncIterable[Any]
+                           chunk_size=100   # type: int
+                           ) -> AsyncIterator[List[Any]]:
+    """Like `iter_row_chunks`, for the results of `acouchbase` queries."""
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+# end::row_chunks[]
+
+
+# tag::prefetching_row_reader[]
+class PrefetchingRowReader(object):
+    """Reads the rows of a query result on a background thread, a bounded number of chunks ahead.
+
+    Reading the next rows overlaps with processing the current ones, but once `max_chunks`
+    chunks are waiting, the reader thread blocks until one is taken, so a slow consumer
+    holds back the query instead of the rows piling up in memory.  Closing the reader
+    early, or leaving a `with` block, stops the thread.
+
+    Args:
+        rows (Iterable): The query result, or its `rows()`
+        chunk_size (int): The most rows in each chunk
+        max_chunks (int): The most chunks read ahead of the consumer
+    """
+
+    _DONE = object()
+
+    def __init__(self,
+                 rows,              # type: Iterable[Any]
+                 chunk_size=100,    # type: int
+                 max_chunks=4       # type: int
+                 ):
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._read,
+                                        args=(rows, chunk_size),
+                                        name='query-row-reader',
+                                        daemon=True)
+        self._thread.start()
+
+    def __iter__(self) -> Iterator[List[Any]]:
+        try:
+            while True:
+                chunk = self._chunks.get()
+                if chunk is self._DONE:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._closed.set()
+        # unblock the reader, if it is waiting for room in the queue
+        while self._thread.is_alive():
+            try:
+                self._chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def _read(self, rows, chunk_size):
+        try:
+            for chunk in iter_row_chunks(rows, chunk_size):
+                if not self._put(chunk):
+                    return
+            self._put(self._DONE)
+        except Exception as ex:
+            self._put(ex)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+# end::prefetching_row_reader[]
+
+
+# tag::stream_json[]
+def stream_json(rows,               # type: Iterable[Any]
+                key='data',         # type: str
+                extra=None,         # type: Optional[Dict[str, Any]]
+                chunk_size=100,     # type: int
+                dumps=json.dumps    # type: Callable[[Any], str]
+                ) -> Iterator[str]:
+    """Yields a JSON object holding the rows under `key`, and the entries of `extra`, piece by piece.
+
+    Each piece holds one chunk of rows, so a web framework can send the response as the
+    rows arrive, rather than building the whole body in memory first.  The rows are read
+    as the pieces are sent, so a slow client slows down reading the query result.  The
+    first chunk is read before the first piece is yielded, so taking the first piece
+    raises any error from the query while an error response can still be sent.
+
+    For example, `stream_json(result, extra={'context': context})` yields the same JSON as
+    `json.dumps({'data': list(result), 'context': context})`.
+    """
+    chunks = iter_row_chunks(rows, chunk_size)
+    first = next(chunks, [])
+    yield '{{{}: [{}'.format(dumps(key), ','.join(dumps(row) for row in first))
+    for chunk in chunks:
+        yield ',' + ','.join(dumps(row) for row in chunk)
+    yield ']'
+    for name, value in (extra or {}).items():
+        yield ', {}: {}'.format(dumps(name), dumps(value))
+    yield '}'
+
+
+async def astream_json(rows,                # type: AsyncIterable[Any]
+                       key='data',          # type: str
+                       extra=None,          # type: Optional[Dict[str, Any]]
+                       chunk_size=100,      # type: int
+                       dumps=json.dumps     # type: Callable[[Any], str]
+                       ) -> AsyncIterator[str]:
+    """Like `stream_json`, for the results of `acouchbase` queries."""
+    chunks = aiter_row_chunks(rows, chunk_size)
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = []
+    yield '{{{}: [{}'.format(dumps(key), ','.join(dumps(row) for row in first))
+    async for chunk in chunks:
+        yield ',' + ','.join(dumps(row) for row in chunk)
+    yield ']'
+    for name, value in (extra or {}).items():
+        yield ', {}: {}'.format(dumps(name), dumps(value))
+    yield '}'
+# end::stream_json[]
@@ -0,0 +1,167 @@
+import asyncio
+import functools
+import random
+import threading
+import time
+from datetime import timedelta
+from enum import Enum
+from typing import Callable, Optional, Tuple, Type
+
+
+# tag::retry_policy[]
+class Jitter(Enum):
+    """How much randomness to add to each backoff delay.
+
+    NONE: exponential backoff, every client retries in lock-step
+    FULL: a random delay between zero and the exponential backoff
+    DECORRELATED: a random delay between the base delay and three times the previous delay
+    """
+    NONE = "none"
+    FULL = "full"
+    DECORRELATED = "decorrelated"
+
+
+class RetryBudget(object):
+    """A token bucket limiting how many retries can be made, shared by every operation that uses it.
+
+    Each retry takes one token, and tokens are refilled at a fixed rate. When the cluster is struggling and
+    every operation starts failing, the budget runs out and operations fail fast, instead of multiplying the
+    load on the cluster with retries.
+
+    Args:
+        max_tokens (int): The most retries that can be made in a burst
+        refill_per_second (float): How many retries per second are allowed once the burst is used up
+    """
+
+    def __init__(self,
+                 max_tokens=10,         # type: int
+                 refill_per_second=1.0  # type: float
+                 ):
+        self._max_tokens = max_tokens
+        self._refill_per_second = refill_per_second
+        self._tokens = float(max_tokens)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._max_tokens,
+                               self._tokens + (now - self._last_refill) * self._refill_per_second)
+            self._last_refill = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """Decides whether, and after how long, a failed operation should be retried.
+
+    Args:
+        retry_limit (int): The maximum number of attempts, including the first
+        base_delay (timedelta): The delay before the first retry, doubled for each retry after it
+        max_delay (timedelta): The longest delay between two attempts
+        jitter (`Jitter`): How much randomness to add to each delay
+        allowed_exceptions (Tuple): The exceptions which are retried, any other exception is raised straight away
+        budget (`RetryBudget`, optional): The retry budget shared with other operations
+        timeout (timedelta, optional): The time allowed for all attempts.  A retry which could not complete
+            before the timeout is not made.  A `timeout` keyword argument passed to the operation takes precedence.
+        on_retry (Callable, optional): Called with the attempt number, the exception and the delay before each retry
+    """
+
+    def __init__(self,
+                 retry_limit=3,                             # type: int
+                 base_delay=timedelta(milliseconds=100),    # type: timedelta
+                 max_delay=timedelta(seconds=5),            # type: timedelta
+                 jitter=Jitter.FULL,                        # type: Jitter
+                 allowed_exceptions=(),                     # type: Tuple[Type[Exception], ...]
+                 budget=None,                               # type: Optional[RetryBudget]
+                 timeout=None,                              # type: Optional[timedelta]
+                 on_retry=None                              # type: Optional[Callable]
+                 ):
+        self.retry_limit = retry_limit
+        self.base_delay = base_delay.total_seconds()
+        self.max_delay = max_delay.total_seconds()
+        self.jitter = jitter
+        self.allowed_exceptions = allowed_exceptions
+        self.budget = budget
+        self.timeout = timeout
+        self.on_retry = on_retry
+
+    def deadline(self, kwargs) -> Optional[float]:
+        timeout = kwargs.get("timeout", None)
+        if not isinstance(timeout, timedelta):
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return time.monotonic() + timeout.total_seconds()
+
+    def next_delay(self, attempt, prev_delay) -> float:
+        if self.jitter == Jitter.DECORRELATED:
+            return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, prev_delay * 3)))
+
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        if self.jitter == Jitter.FULL:
+            return random.uniform(0, delay)
+        return delay
+
+    def should_retry(self, attempt, ex, delay, deadline) -> bool:
+        if not isinstance(ex, self.allowed_exceptions):
+            return False
+        if attempt >= self.retry_limit:
+            return False
+        # no point waiting for a retry which would not finish in time
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return False
+        # check the budget last, so a token is only taken for a retry that is made
+        if self.budget is not None and not self.budget.try_acquire():
+            return False
+        if self.on_retry is not None:
+            self.on_retry(attempt, ex, delay)
+        return True
+
+
+def retry(policy  # type: RetryPolicy
+          ) -> Callable:
+    """Decorator which retries the decorated function according to the given `RetryPolicy`.
+
+    Coroutine functions are retried with `asyncio.sleep`, so waiting for a retry never blocks the event loop.
+    """
+    def handle_retries(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_func_wrapper(*args, **kwargs):
+                deadline = policy.deadline(kwargs)
+                delay = policy.base_delay
+                attempt = 1
+                while True:
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception as ex:
+                        delay = policy.next_delay(attempt, delay)
+                        if not policy.should_retry(attempt, ex, delay, deadline):
+                            raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+
+            return async_func_wrapper
+
+        @functools.wraps(func)
+        def func_wrapper(*args, **kwargs):
+            deadline = policy.deadline(kwargs)
+            delay = policy.base_delay
+            attempt = 1
+            while True:
+                try:
+                    return func(*args, **kwargs)
+                except Exception as ex:
+                    delay = policy.next_delay(attempt, delay)
+                    if not policy.should_retry(attempt, ex, delay, deadline):
+                        raise
+                time.sleep(delay)
+                attempt += 1
+
+        return func_wrapper
+    return handle_retries
+# end::retry_policy[]
@@ -0,0 +1,165 @@
+import heapq
+import itertools
+import json
+import logging
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from metrics_helpers import nearest_rank
+
+
+# tag::slow_ops_analyzer[]
+THRESHOLD = 'threshold'
+ORPHAN = 'orphan'
+
+
+def parse_sdk_report(message  # type: str
+                     ) -> Tuple[Optional[str], Optional[Dict]]:
+    """Parses a threshold or orphan report logged by the SDK.
+
+    Returns:
+        Tuple: The kind of report, `THRESHOLD` or `ORPHAN`, and the report by service,
+            or (None, None) if the message isn't a report
+    """
+    lowered = message.lower()
+    if 'orphan' in lowered:
+        kind = ORPHAN
+    elif 'threshold' in lowered:
+        kind = THRESHOLD
+    else:
+        return None, None
+    start = message.find('{')
+    if start < 0:
+        return None, None
+    try:
+        report = json.loads(message[start:])
+    except ValueError:
+        return None, None
+    return (kind, report) if isinstance(report, dict) else (None, None)
+
+
+class SlowOpsAnalyzer(logging.Handler):
+    """Logging handler which aggregates the threshold and orphan reports logged by the SDK.
+
+    The SDK periodically logs the slowest operations (threshold reports) and the responses
+    which arrived after the operation had timed out (orphan reports) as JSON.  Instead of
+    grepping the logs for them, this handler parses each report as it is logged and keeps:
+
+    * the `top_n` slowest operations for each kind of report, service and operation
+    * the most recent `max_samples` server, network and encode durations for each kind of
+      report and service, for percentile breakdowns
+
+    Every other log record is ignored, so the handler can sit alongside any other handler.
+
+    Args:
+        top_n (int): How many of the slowest operations to keep per service and operation
+        max_samples (int): How many durations to keep per service for the percentiles
+    """
+
+    def __init__(self,
+                 top_n=10,          # type: int
+                 max_samples=10000  # type: int
+                 ):
+        super().__init__()
+        self._top_n = top_n
+        self._max_samples = max_samples
+        # (kind, service, operation) -> min-heap of (total_duration_us, seq, entry)
+        self._slowest = {}
+        # (kind, service) -> {'server'|'network'|'encode'|'total': deque of durations in us}
+        self._durations = {}
+        self._counts = {}
+        self._seq = itertools.count()
+
+    def emit(self, record):
+        kind, report = parse_sdk_report(record.getMessage())
+        if report is None:
+            return
+        # logging.Handler.handle() holds self.lock around emit()
+        for service, service_report in report.items():
+            if not isinstance(service_report, dict):
+                continue
+            self._counts[(kind, service)] = (self._counts.get((kind, service), 0)
+                                             + service_report.get('total_count', 0))
+            for entry in service_report.get('top_requests', []):
+                self._record(kind, service, entry)
+
+    def top(self,
+            kind=THRESHOLD,     # type: str
+            service=None,       # type: Optional[str]
+            operation=None      # type: Optional[str]
+            ) -> List[Dict]:
+        """Returns the slowest operations recorded, slowest first, optionally only those of a service and operation."""
+        with self.lock:
+            entries = [entry for (k, svc, op), heap in self._slowest.items()
+                       if k == kind and service in (None, svc) and operation in (None, op)
+                       for _, _, entry in heap]
+        entries.sort(key=lambda e: e.get('total_duration_us', 0), reverse=True)
+        return entries[:self._top_n]
+
+    def breakdown(self,
+                  kind=THRESHOLD,           # type: str
+                  service='kv',             # type: str
+                  percentiles=(50, 95, 99)  # type: tuple
+                  ) -> Dict[str, Dict[int, int]]:
+        """Returns percentiles, in microseconds, of the total, server, network and encode time of a service."""
+        with self.lock:
+            durations = {part: sorted(samples)
+                         for part, samples in self._durations.get((kind, service), {}).items()}
+        return {part: {p: nearest_rank(samples, p) for p in percentiles}
+                for part, samples in durations.items() if samples}
+
+    def report(self) -> Dict[str, Dict[str, Dict]]:
+        """Returns, for each kind of report and service, the number of operations reported,
+        the duration percentiles and the slowest operations."""
+        with self.lock:
+            keys = sorted(self._counts)
+            counts = dict(self._counts)
+        result = {}
+        for kind, service in keys:
+            result.setdefault(kind, {})[service] = {
+                'total_count': counts[(kind, service)],
+                'breakdown_us': self.breakdown(kind, service),
+                'slowest': self.top(kind, service)
+            }
+        return result
+
+    def _record(self, kind, service, entry):
+        operation = entry.get('operation_name', 'unknown')
+        total = entry.get('total_duration_us', 0)
+        heap = self._slowest.setdefault((kind, service, operation), [])
+        item = (total, next(self._seq), entry)
+        if len(heap) < self._top_n:
+            heapq.heappush(heap, item)
+        elif total > heap[0][0]:
+            heapq.heapreplace(heap, item)
+
+        durations = self._durations.get((kind, service))
+        if durations is None:
+            durations = self._durations[(kind, service)] = {
+                part: deque(maxlen=self._max_samples)
+                for part in ('total', 'server', 'network', 'encode')}
+        durations['total'].append(total)
+        server = entry.get('last_server_duration_us')
+        dispatch = entry.get('last_dispatch_duration_us')
+        encode = entry.get('encode_duration_us')
+        if server is not None:
+            durations['server'].append(server)
+        # the time spent on the wire is the part of the dispatch the server didn't account for
+        if dispatch is not None:
+            durations['network'].append(max(0, dispatch - (server or 0)))
+        if encode is not None:
+            durations['encode'].append(encode)
+
+
+def attach_slow_ops_analyzer(logger,         # type: logging.Logger
+                             analyzer=None   # type: Optional[SlowOpsAnalyzer]
+                             ) -> SlowOpsAnalyzer:
+    """Adds a `SlowOpsAnalyzer` to `logger`.
+
+    Only one logger can receive the SDK's logs, so sending them to `logger` with
+    `couchbase.configure_logging` is left to the application.
+    """
+    analyzer = analyzer or SlowOpsAnalyzer()
+    logger.addHandler(analyzer)
+    return analyzer
+# end::slow_ops_analyzer[]
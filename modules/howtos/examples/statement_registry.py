@@ -0,0 +1,159 @@
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+from metrics_helpers import collapse_whitespace
+
+
+# tag::statement_stats[]
+class StatementStats(object):
+    """Execution counts and timings of one SQL++ statement."""
+
+    def __init__(self, statement):
+        self.statement = statement
+        self.executions = 0
+        self.prepared_executions = 0
+        self.completed = 0
+        self.execution_time = timedelta()
+        self.elapsed_time = timedelta()
+        self.result_count = 0
+
+    @property
+    def mean_execution_time(self) -> Optional[timedelta]:
+        return self.execution_time / self.completed if self.completed else None
+
+    def asdict(self) -> Dict[str, Any]:
+        return {
+            'statement': self.statement,
+            'executions': self.executions,
+            'prepared_executions': self.prepared_executions,
+            'mean_execution_time': self.mean_execution_time,
+            'total_execution_time': self.execution_time,
+            'mean_result_count': self.result_count / self.completed if self.completed else None
+        }
+# end::statement_stats[]
+
+
+# tag::statement_registry[]
+class StatementRegistry(object):
+    """Runs SQL++ queries, preparing the statements which are run repeatedly, and tracks how each statement performs.
+
+    The query service has to parse and plan an ad hoc statement every time it runs.  Once the
+    same statement text has been run `prepare_after` times, it is run with `adhoc=False`, so the
+    query service plans it once and reuses the plan.  Every query is run with `metrics=True`, and
+    once its rows have been read, its execution time is recorded against the statement.
+
+    Only parameterized statements repeat: a statement with its values inlined is a different
+    statement for every value, which is never prepared and fills the registry.
+
+    Args:
+        prepare_after (int): How many times a statement is run ad hoc before it is prepared,
+            None never prepares statements, but still reports which ones should be
+        max_statements (int): The most statements to track, the least recently run are dropped
+        slow_execution_time (timedelta): Statements slower than this on average are reported
+            as candidates for an index
+    """
+
+    def __init__(self,
+                 prepare_after=2,                                   # type: Optional[int]
+                 max_statements=1000,                               # type: int
+                 slow_execution_time=timedelta(milliseconds=100)    # type: timedelta
+                 ):
+        self._prepare_after = prepare_after
+        self._max_statements = max_statements
+        self._slow_execution_time = slow_execution_time
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def query(self,
+              target,       # type: Any
+              statement,    # type: str
+              *options,     # type: Any
+              **kwargs      # type: Any
+              ):
+        """Runs `statement` with `target.query()`, where `target` is a `Cluster` or a `Scope`.
+
+        Takes the same arguments as `query()`, and returns its result, which records the
+        execution time of the statement once all its rows have been read.
+        """
+        key = collapse_whitespace(statement)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = StatementStats(key)
+                if len(self._stats) > self._max_statements:
+                    self._stats.popitem(last=False)
+            else:
+                self._stats.move_to_end(key)
+            prepared = (self._prepare_after is not None
+                        and stats.executions >= self._prepare_after)
+            stats.executions += 1
+            if prepared:
+                stats.prepared_executions += 1
+
+        # keyword arguments take precedence over the QueryOptions passed in
+        kwargs['metrics'] = True
+        if prepared:
+            kwargs['adhoc'] = False
+        result = target.query(statement, *options, **kwargs)
+        return TrackedQueryResult(result, self, stats)
+
+    def record(self, stats, metrics):
+        with self._lock:
+            stats.completed += 1
+            stats.execution_time += metrics.execution_time()
+            stats.elapsed_time += metrics.elapsed_time()
+            stats.result_count += metrics.result_count()
+
+    def stats(self) -> List[StatementStats]:
+        with self._lock:
+            return list(self._stats.values())
+
+    def report(self, top=10) -> List[Dict[str, Any]]:
+        """Returns the `top` statements by total execution time, with recommendations."""
+        with self._lock:
+            entries = [(stats.asdict(), stats.executions - stats.prepared_executions)
+                       for stats in self._stats.values()]
+        entries.sort(key=lambda e: e[0]['total_execution_time'], reverse=True)
+        report = []
+        for entry, adhoc_executions in entries[:top]:
+            recommendations = []
+            always_adhoc = adhoc_executions == entry['executions']
+            if always_adhoc and entry['executions'] > (self._prepare_after or 1):
+                recommendations.append('prepare: run {} times, always ad hoc'.format(entry['executions']))
+            mean = entry['mean_execution_time']
+            if mean is not None and mean > self._slow_execution_time:
+                recommendations.append('index: mean execution time {}, check the plan with EXPLAIN'.format(mean))
+            entry['recommendations'] = recommendations
+            report.append(entry)
+        return report
+
+
+class TrackedQueryResult(object):
+    """Wraps a query result, recording its metrics in the `StatementRegistry` once its rows have been read.
+
+    Subclasses record something else by overriding `record`.
+    """
+
+    def __init__(self, result, registry, stats):
+        self._result = result
+        self._registry = registry
+        self._stats = stats
+
+    def __iter__(self):
+        return self.rows()
+
+    def rows(self):
+        for row in self._result.rows():
+            yield row
+        self.record(self._result.metadata())
+
+    def record(self, metadata):
+        metrics = metadata.metrics()
+        if metrics is not None:
+            self._registry.record(self._stats, metrics)
+
+    def __getattr__(self, name):
+        return getattr(self._result, name)
+# end::statement_registry[]
@@ -0,0 +1,206 @@
+from collections import OrderedDict
+from typing import Any, Dict, Sequence
+
+# the most sub-document operations the server accepts in one lookup_in or mutate_in
+MAX_SPECS = 16
+
+
+# tag::subdoc_planner[]
+class SubdocPlanner(object):
+    """Collects the sub-document lookups and mutations of a request, and sends them in the fewest
+    `lookup_in` and `mutate_in` calls.
+
+    `lookup_in()` and `mutate_in()` take the same arguments as the collection's, but only queue
+    the specs, and return a `PlannedResult` at once.  On `execute()`, or when any of the results
+    is first read, the specs queued for each key are sent together, up to `max_specs` per call.
+    A lookup spec queued more than once for a key is only sent once.  The lookups of a key are
+    sent before its mutations, so a lookup queued after a mutation of the same key first sends
+    everything queued for that key, and then reads the mutated document.
+
+    The specs of each `lookup_in()` or `mutate_in()` are kept in one call, so they're still read
+    from the same version of the document, or applied atomically.  But the mutations of other
+    callers in that call are applied atomically with them: if one fails, none are applied.
+    Mutations which need options, such as a CAS or durability, should be sent with the
+    collection directly.
+
+    A planner is meant for a single request, on a single thread.
+
+    Args:
+        collection (Collection): The collection the documents are in
+        max_specs (int): The most specs to send in one call
+    """
+
+    def __init__(self,
+                 collection,
+                 max_specs=MAX_SPECS    # type: int
+                 ):
+        self._collection = collection
+        self._max_specs = max_specs
+        self._lookups = OrderedDict()
+        self._mutations = OrderedDict()
+        self._pending = []
+        self._requested_calls = 0
+        self._requested_specs = 0
+        self._issued_calls = 0
+        self._issued_specs = 0
+
+    def lookup_in(self,
+                  key,      # type: str
+                  specs     # type: Sequence[Any]
+                  ) -> 'PlannedResult':
+        if key in self._mutations:
+            # would otherwise be sent before the mutations queued ahead of it
+            self._send_queued(key)
+        chunks = self._lookups.setdefault(key, [])
+        return self._plan('lookup', key, specs, self._add(chunks, specs, merge=True))
+
+    def mutate_in(self,
+                  key,      # type: str
+                  specs     # type: Sequence[Any]
+                  ) -> 'PlannedResult':
+        chunks = self._mutations.setdefault(key, [])
+        # mutations are never merged, each one is applied, in the order they were queued
+        return self._plan('mutate', key, specs, self._add(chunks, specs, merge=False))
+
+    def execute(self):
+        """Sends the queued specs, and resolves their results."""
+        self._send_queued()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the calls and specs requested by callers, and those actually sent."""
+        return {
+            'requested_calls': self._requested_calls,
+            'requested_specs': self._requested_specs,
+            'issued_calls': self._issued_calls,
+            'issued_specs': self._issued_specs
+        }
+
+    def _send_queued(self, only_key=None):
+        # sends the specs queued for one key, or for every key
+        if only_key is None:
+            lookups, mutations, pending = self._lookups, self._mutations, self._pending
+            self._lookups, self._mutations, self._pending = OrderedDict(), OrderedDict(), []
+        else:
+            lookups = {only_key: self._lookups.pop(only_key)} if only_key in self._lookups else {}
+            mutations = {only_key: self._mutations.pop(only_key)} if only_key in self._mutations else {}
+            pending = [planned for planned in self._pending if planned.key == only_key]
+            self._pending = [planned for planned in self._pending if planned.key != only_key]
+
+        calls = {}
+        for key, chunks in lookups.items():
+            calls[('lookup', key)] = self._send(self._collection.lookup_in, key, chunks)
+        for key, chunks in mutations.items():
+            calls[('mutate', key)] = self._send(self._collection.mutate_in, key, chunks)
+        for planned in pending:
+            planned._resolve(calls[(planned.kind, planned.key)])
+
+    def _plan(self, kind, key, specs, locations):
+        self._requested_calls += 1
+        self._requested_specs += len(specs)
+        planned = PlannedResult(self, kind, key, locations)
+        self._pending.append(planned)
+        return planned
+
+    def _add(self, chunks, specs, merge):
+        """Adds the specs of one caller to the calls queued for a key, returning where each one went.
+
+        The specs are kept in one call, started afresh if the last one hasn't room for them,
+        so they're read from the same version of the document, or applied atomically, as
+        they would have been by the caller's own call.
+        """
+        spec_keys = [_spec_key(spec, merge) for spec in specs]
+        if not chunks or len(chunks[-1]) + len(set(spec_keys) - set(chunks[-1])) > self._max_specs:
+            chunks.append(OrderedDict())
+        locations = []
+        for spec, spec_key in zip(specs, spec_keys):
+            chunk = chunks[-1]
+            if spec_key not in chunk and len(chunk) >= self._max_specs:
+                # more specs than fit in one call
+                chunk = OrderedDict()
+                chunks.append(chunk)
+            if spec_key not in chunk:
+                chunk[spec_key] = (len(chunk), spec)
+            locations.append((len(chunks) - 1, chunk[spec_key][0]))
+        return locations
+
+    def _send(self, operation, key, chunks):
+        # the result, or the exception raised, of each call
+        outcomes = []
+        for chunk in chunks:
+            specs = [spec for _, spec in chunk.values()]
+            self._issued_calls += 1
+            self._issued_specs += len(specs)
+            try:
+                outcomes.append(operation(key, specs))
+            except Exception as ex:
+                outcomes.append(ex)
+        return outcomes
+
+
+def _spec_key(spec, merge):
+    if merge:
+        try:
+            # the same lookup, queued again, reads the same value
+            hash(spec)
+            return spec
+        except TypeError:
+            pass
+    return object()
+
+
+class PlannedResult(object):
+    """The result of a lookup or mutation queued with a `SubdocPlanner`.
+
+    Reads like a `LookupInResult` or `MutateInResult`: `content_as[type](index)`, `exists(index)`
+    and `cas`, where `index` is the position of the spec in the list it was queued with.  Reading
+    it first sends everything still queued in the planner.  If the call for a spec failed as a
+    whole, such as when the document doesn't exist, reading the spec raises that exception.
+    """
+
+    def __init__(self, planner, kind, key, locations):
+        self._planner = planner
+        self.kind = kind
+        self.key = key
+        self._locations = locations
+        self._outcomes = None
+
+    @property
+    def content_as(self):
+        return _ContentAs(self)
+
+    def exists(self,
+               index    # type: int
+               ) -> bool:
+        result, result_index = self._locate(index)
+        return result.exists(result_index)
+
+    @property
+    def cas(self) -> int:
+        """The CAS of the document, as of the call which sent the last of these specs."""
+        result, _ = self._locate(len(self._locations) - 1)
+        return result.cas
+
+    def _resolve(self, outcomes):
+        self._outcomes = outcomes
+
+    def _locate(self, index):
+        if self._outcomes is None:
+            self._planner.execute()
+        call, call_index = self._locations[index]
+        outcome = self._outcomes[call]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome, call_index
+
+
+class _ContentAs(object):
+
+    def __init__(self, planned):
+        self._planned = planned
+
+    def __getitem__(self, type_):
+        def content(index):
+            result, result_index = self._planned._locate(index)
+            return result.content_as[type_](result_index)
+        return content
+# end::subdoc_planner[]
@@ -13,6 +13,8 @@ from couchbase.auth import PasswordAuthenticator
 import couchbase.subdocument as SD
 from couchbase.options import MutateInOptions
 
+from subdoc_planner import SubdocPlanner
+
 cluster = Cluster(
     "couchbase://your-ip",
     authenticator=PasswordAuthenticator(
@@ -89,6 +91,25 @@ print("Path exists: {}.".format(result.exists(1)))
 # path exists: True.
 # end::lookup_in_multi[]
 
+# tag::subdoc_planner_usage[]
+planner = SubdocPlanner(collection)
+# e.g. from different parts of the code serving one request
+country = planner.lookup_in("customer123", [SD.get("addresses.delivery.country")])
+purchases = planner.lookup_in("customer123",
+                              [SD.get("purchases.complete"),
+                               SD.exists("purchases.pending")])
+# queued again, but only sent once
+country_again = planner.lookup_in("customer123", [SD.get("addresses.delivery.country")])
+
+# reading any of the results sends a single lookup_in, with 3 specs
+print("{0}".format(country.content_as[str](0)))
+print("Complete: {}, pending: {}.".format(
+    purchases.content_as[list](0), purchases.exists(1)))
+print("{0}".format(country_again.content_as[str](0)))
+print(planner.stats())
+# {'requested_calls': 3, 'requested_specs': 4, 'issued_calls': 1, 'issued_specs': 3}
+# end::subdoc_planner_usage[]
+
 # tag::mutate_in_upsert[]
 collection.mutate_in("customer123", [SD.upsert("fax", "311-555-0151")])
 # end::mutate_in_upsert[]
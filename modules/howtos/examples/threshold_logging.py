@@ -9,6 +9,8 @@ from couchbase.options import ClusterOptions, ClusterTracingOptions
 from couchbase.auth import PasswordAuthenticator
 from couchbase.exceptions import CouchbaseException
 
+from slow_ops_analyzer import attach_slow_ops_analyzer
+
 # NOTE: for simple test to see output, drop the threshold
 #         ex:  tracing_threshold_kv=timedelta(microseconds=1)
 
@@ -34,10 +36,28 @@ cluster = Cluster(
 )
 # end::threshold_logging_config[]
 
+# tag::slow_ops_analyzer_config[]
+# collect the threshold and orphan reports as the SDK logs them
+slow_ops = attach_slow_ops_analyzer(logger)
+# end::slow_ops_analyzer_config[]
+
 collection = cluster.bucket("beer-sample").default_collection()
 
 for _ in range(100):
     try:
         collection.get("21st_amendment_brewery_cafe")
     except CouchbaseException:
-        logger.error(traceback.format_exc())
\ No newline at end of file
+        logger.error(traceback.format_exc())
+
+# tag::slow_ops_analyzer_report[]
+# reports are logged at the end of each emit interval, so this may be empty
+# when the script runs for less than one interval
+for kind, services in slow_ops.report().items():
+    for service, summary in services.items():
+        print("{0} {1}: {2} operations".format(kind, service, summary["total_count"]))
+        for part, percentiles in summary["breakdown_us"].items():
+            print("  {0:<8} p50 {1}us, p95 {2}us, p99 {3}us".format(
+                part, percentiles[50], percentiles[95], percentiles[99]))
+        for entry in summary["slowest"]:
+            print("  {0} took {1}us".format(entry.get("operation_name"), entry.get("total_duration_us")))
+# end::slow_ops_analyzer_report[]
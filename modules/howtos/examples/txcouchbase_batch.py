@@ -0,0 +1,174 @@
+from collections import Counter, namedtuple
+from typing import Any, Callable, Dict, Iterable, List, Sequence
+
+from twisted.internet.defer import Deferred, DeferredList, DeferredSemaphore
+from twisted.internet.task import LoopingCall
+
+
+# tag::batch_result[]
+class BatchResult(object):
+    """The outcome of a batch of operations, with the result or the exception for each key.
+
+    Like the `MultiResult` of the SDK's `*_multi` operations, keys which succeeded are in
+    `results`, and keys which failed in `exceptions`, both in the order of the keys.
+    """
+
+    def __init__(self,
+                 keys,          # type: Sequence[str]
+                 outcomes       # type: List[tuple]
+                 ):
+        self.results = {}
+        self.exceptions = {}
+        for key, (success, value) in zip(keys, outcomes):
+            if success:
+                self.results[key] = value
+            else:
+                self.exceptions[key] = value.value
+
+    @property
+    def all_ok(self) -> bool:
+        return not self.exceptions
+
+    def error_counts(self) -> Dict[str, int]:
+        """Returns the number of failed keys by exception type, most common first."""
+        counts = Counter(type(ex).__name__ for ex in self.exceptions.values())
+        return dict(counts.most_common())
+
+    def summary(self) -> str:
+        line = '{} succeeded, {} failed'.format(len(self.results), len(self.exceptions))
+        if self.exceptions:
+            line += ' ({})'.format(', '.join('{}: {}'.format(name, count)
+                                             for name, count in self.error_counts().items()))
+        return line
+# end::batch_result[]
+
+
+# tag::run_bounded[]
+def run_bounded(items,            # type: Sequence[Any]
+                operation,        # type: Callable[[Any], Deferred]
+                concurrency=64    # type: int
+                ) -> Deferred:
+    """Runs `operation` for each item, with at most `concurrency` operations in flight at once.
+
+    Returns:
+        Deferred: Fires with a `DeferredList` result, a `(success, result or Failure)` tuple for
+            each item, in the order of `items`.  It never errbacks, failures are in the tuples.
+    """
+    semaphore = DeferredSemaphore(concurrency)
+    # consumeErrors, so a failed operation isn't also logged as an unhandled error
+    return DeferredList([semaphore.run(operation, item) for item in items], consumeErrors=True)
+# end::run_bounded[]
+
+
+# tag::kv_batch[]
+def get_batch(collection,
+              keys,             # type: Iterable[str]
+              *opts,            # type: Any
+              concurrency=64,   # type: int
+              **kwargs          # type: Any
+              ) -> Deferred:
+    """Gets each key with `collection.get()`, with at most `concurrency` gets in flight.
+
+    Returns:
+        Deferred: Fires with a `BatchResult` of `GetResult`
+    """
+    keys = list(keys)
+    d = run_bounded(keys, lambda key: collection.get(key, *opts, **kwargs), concurrency)
+    return d.addCallback(lambda outcomes: BatchResult(keys, outcomes))
+
+
+def upsert_batch(collection,
+                 docs,              # type: Dict[str, Any]
+                 *opts,             # type: Any
+                 concurrency=64,    # type: int
+                 **kwargs           # type: Any
+                 ) -> Deferred:
+    """Upserts each document with `collection.upsert()`, with at most `concurrency` upserts in flight.
+
+    Returns:
+        Deferred: Fires with a `BatchResult` of `MutationResult`
+    """
+    keys = list(docs)
+    d = run_bounded(keys, lambda key: collection.upsert(key, docs[key], *opts, **kwargs), concurrency)
+    return d.addCallback(lambda outcomes: BatchResult(keys, outcomes))
+
+
+def lookup_in_batch(collection,
+                    keys,               # type: Iterable[str]
+                    specs,              # type: Sequence[Any]
+                    *opts,              # type: Any
+                    concurrency=64,     # type: int
+                    **kwargs            # type: Any
+                    ) -> Deferred:
+    """Looks up the same `specs` in each key with `collection.lookup_in()`, with at most
+    `concurrency` lookups in flight.
+
+    Returns:
+        Deferred: Fires with a `BatchResult` of `LookupInResult`
+    """
+    keys = list(keys)
+    d = run_bounded(keys, lambda key: collection.lookup_in(key, specs, *opts, **kwargs), concurrency)
+    return d.addCallback(lambda outcomes: BatchResult(keys, outcomes))
+
+
+def remove_batch(collection,
+                 keys,              # type: Iterable[str]
+                 *opts,             # type: Any
+                 concurrency=64,    # type: int
+                 **kwargs           # type: Any
+                 ) -> Deferred:
+    """Removes each key with `collection.remove()`, with at most `concurrency` removes in flight.
+
+    Returns:
+        Deferred: Fires with a `BatchResult` of `MutationResult`
+    """
+    keys = list(keys)
+    d = run_bounded(keys, lambda key: collection.remove(key, *opts, **kwargs), concurrency)
+    return d.addCallback(lambda outcomes: BatchResult(keys, outcomes))
+# end::kv_batch[]
+
+
+# tag::time_batch[]
+BatchTiming = namedtuple('BatchTiming', ['result', 'elapsed', 'ops_per_second', 'max_reactor_lag'])
+
+
+def time_batch(reactor,
+               batch,               # type: Callable[..., Deferred]
+               *args,               # type: Any
+               lag_interval=0.01,   # type: float
+               **kwargs             # type: Any
+               ) -> Deferred:
+    """Runs `batch(*args, **kwargs)`, timing it on the reactor's clock.
+
+    While the batch runs, a `LoopingCall` checks how late the reactor runs it, every
+    `lag_interval` seconds.  A large lag means callbacks are blocking the reactor, so every
+    other request the process serves waits too, however fast the batch itself is.
+
+    Returns:
+        Deferred: Fires with a `BatchTiming` of the `BatchResult`, the elapsed seconds,
+            the operations per second, and the largest reactor lag seen, in seconds
+    """
+    lag = {'max': 0.0, 'due': reactor.seconds() + lag_interval}
+
+    def check_lag():
+        now = reactor.seconds()
+        lag['max'] = max(lag['max'], now - lag['due'])
+        lag['due'] = now + lag_interval
+
+    monitor = LoopingCall(check_lag)
+    monitor.clock = reactor
+    monitor.start(lag_interval, now=False)
+
+    start = reactor.seconds()
+
+    def stop_monitor(passthrough):
+        monitor.stop()
+        return passthrough
+
+    def on_done(result):
+        elapsed = reactor.seconds() - start
+        ops = len(result.results) + len(result.exceptions)
+        return BatchTiming(result, elapsed, ops / elapsed if elapsed else 0.0, lag['max'])
+
+    return batch(*args, **kwargs).addBoth(stop_monitor).addCallback(on_done)
+# end::time_batch[]
@@ -24,6 +24,9 @@ from txcouchbase.cluster import TxCluster
 from couchbase.result import GetResult, LookupInResult
 # end::txcouchbase_imports[]
 
+# used for bounded batches of key-value operations
+from txcouchbase_batch import get_batch, lookup_in_batch, remove_batch, time_batch, upsert_batch
+
 # tag::kv[]
 def on_kv_ok(result):
     if isinstance(result, GetResult):
@@ -78,6 +81,44 @@ def sub_doc_operations(collection):
 # end::sub_doc[]
 
 
+# tag::kv_batch[]
+def on_batch_error(error):
+    print("Batch had an error.\nError: {}".format(error))
+
+
+def kv_batch_operations(collection):
+    docs = {"hotel_batch_{}".format(i): {"type": "hotel", "id": i, "name": "Hotel {}".format(i)}
+            for i in range(100)}
+    keys = list(docs) + ["not-a-key"]
+
+    def on_upserted(timing):
+        print("Upsert batch: {} in {:.3f}s, max reactor lag {:.3f}s".format(
+            timing.result.summary(), timing.elapsed, timing.max_reactor_lag))
+        # at most 16 gets in flight at once
+        return time_batch(reactor, get_batch, collection, keys, concurrency=16)
+
+    def on_got(timing):
+        # "100 succeeded, 1 failed (DocumentNotFoundException: 1)"
+        print("Get batch: {} ({:.0f} ops/s)".format(timing.result.summary(), timing.ops_per_second))
+        for key, ex in timing.result.exceptions.items():
+            print("Failed to get {}: {}".format(key, ex))
+        return lookup_in_batch(collection, list(docs)[:10], [SD.get("name")], concurrency=16)
+
+    def on_looked_up(result):
+        for key, res in result.results.items():
+            print("{}: {}".format(key, res.content_as[str](0)))
+        # clean up the example documents
+        return remove_batch(collection, docs, concurrency=16)
+
+    def on_removed(result):
+        print("Remove batch: {}".format(result.summary()))
+
+    d = time_batch(reactor, upsert_batch, collection, docs, concurrency=16)
+    d.addCallback(on_upserted).addCallback(on_got).addCallback(on_looked_up).addCallback(on_removed)
+    d.addErrback(on_batch_error)
+# end::kv_batch[]
+
+
 def on_streaming_error(error):
     print("Streaming operation had an error.\nError: {}".format(error))
 
@@ -124,6 +165,7 @@ def analytics_query(cluster):
 def do_stuff(cluster, bucket, cb_coll, cb_coll_default):
     kv_operations(cb_coll)
     sub_doc_operations(cb_coll)
+    kv_batch_operations(cb_coll)
     n1ql_query(cluster)
     search_query(cluster)
     analytics_query(cluster)
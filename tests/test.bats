@@ -7,8 +7,18 @@ load 'test_helper'
   assert_success
 }
 
+@test "[hello-world] - sample_app_benchmark.py" {
+  runExample $HELLO_WORLD_DIR sample_app_benchmark.py
+  assert_success
+}
+
 ### Howtos tests
 
+@test "[howtos] - acouchbase_batch_benchmark.py" {
+  runExample $HOWTOS_DIR acouchbase_batch_benchmark.py
+  assert_success
+}
+
 @test "[howtos] - acouchbase_n1ql_ops.py" {
   runExample $HOWTOS_DIR acouchbase_n1ql_ops.py
   assert_success